@@ -0,0 +1,86 @@
+MAX_ALBUM_SIZE = 10  # Больше частей Telegram в один альбом не собирает
+
+
+class Album:
+    """Части одного grouped_id, собранные при выборке.
+
+    Для остального кода выглядит как одно сообщение: id - последней части
+    (курсор источника сдвигается сразу за альбом), текст и медиа - первые
+    непустые, так что фильтры, дедупликация и подписи работают без изменений.
+    """
+
+    __slots__ = ('messages',)
+
+    def __init__(self, messages):
+        self.messages = sorted(messages, key=lambda m: m.id)
+
+    def add(self, message):
+        if all(m.id != message.id for m in self.messages):
+            self.messages.append(message)
+            self.messages.sort(key=lambda m: m.id)
+
+    @property
+    def id(self):
+        return self.messages[-1].id
+
+    @property
+    def ids(self):
+        return [m.id for m in self.messages]
+
+    @property
+    def grouped_id(self):
+        return self.messages[0].grouped_id
+
+    @property
+    def text(self):
+        return next((m.text for m in self.messages if m.text), None)
+
+    @property
+    def media(self):
+        return next((m.media for m in self.messages if m.media), None)
+
+    @property
+    def reply_to(self):
+        return next((m.reply_to for m in self.messages if getattr(m, 'reply_to', None)), None)
+
+    @property
+    def date(self):
+        return self.messages[0].date
+
+    @property
+    def peer_id(self):
+        return self.messages[0].peer_id
+
+
+async def group_albums(messages):
+    """Поток сообщений (по возрастанию id) -> сообщения и альбомы; части альбома идут подряд"""
+    album = None
+    async for message in messages:
+        grouped_id = getattr(message, 'grouped_id', None)
+        if album is not None and grouped_id == album.grouped_id:
+            album.add(message)
+            continue
+        if album is not None:
+            yield album
+            album = None
+        if grouped_id:
+            album = Album([message])
+        else:
+            yield message
+    if album is not None:
+        yield album
+
+
+async def complete_album(client, peer, album):
+    """Дозапрос частей альбома, оборванного границей выборки: один get_messages по соседним id"""
+    missing = MAX_ALBUM_SIZE - len(album.messages)
+    if missing <= 0:
+        return album
+    ids = list(range(album.id + 1, album.id + 1 + missing))
+    for message in await client.get_messages(peer, ids=ids):
+        if message is None:
+            continue  # Удалённое сообщение
+        if getattr(message, 'grouped_id', None) != album.grouped_id:
+            break
+        album.add(message)
+    return album
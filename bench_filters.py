@@ -0,0 +1,59 @@
+"""Микробенчмарк фильтра сообщений: старый перебор ключевых слов против автомата Ахо-Корасик.
+
+Запуск: python bench_filters.py [число_сообщений]
+"""
+import random
+import sys
+import time
+
+from filters import MessageFilter
+
+ALPHABET = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюяabcdefghijklmnopqrstuvwxyz'
+
+
+def random_word(rnd, low=4, high=10):
+    return ''.join(rnd.choice(ALPHABET) for _ in range(rnd.randint(low, high)))
+
+
+def make_message(rnd, vocabulary, length):
+    words = []
+    while sum(len(w) + 1 for w in words) < length:
+        words.append(rnd.choice(vocabulary))
+    return ' '.join(words).capitalize()
+
+
+def old_should_copy(text, keywords):
+    # Как было в TelegramChannelCopier._should_copy
+    text = text.lower()
+    keywords_lower = [k.lower() for k in keywords]
+    return any(k in text for k in keywords_lower)
+
+
+def bench(func, messages):
+    start = time.perf_counter()
+    for text in messages:
+        func(text)
+    return (time.perf_counter() - start) / len(messages)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rnd = random.Random(42)
+    vocabulary = [random_word(rnd, 2, 9) for _ in range(5000)]
+
+    print(f"{'слов':>6} | {'длина':>6} | {'перебор, мкс':>13} | {'фильтр, мкс':>13} | {'сборка, мс':>10}")
+    for keyword_count in (100, 1000, 5000):
+        # Ключевые слова, которые в текстах не встречаются - худший случай для перебора
+        keywords = [random_word(rnd, 6, 12) for _ in range(keyword_count)]
+        started = time.perf_counter()
+        message_filter = MessageFilter(keywords, excluded=keywords[:50])
+        build_ms = (time.perf_counter() - started) * 1000
+        for length in (200, 1000, 4000):  # Подпись к фото, обычный пост, длинный пост
+            messages = [make_message(rnd, vocabulary, length) for _ in range(count)]
+            old = bench(lambda t: old_should_copy(t, keywords), messages)
+            new = bench(message_filter.matches, messages)
+            print(f"{keyword_count:>6} | {length:>6} | {old * 1e6:>13.1f} | {new * 1e6:>13.1f} | {build_ms:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Бенчмарк стоимости сохранения прогресса на одно сообщение: полная перезапись state.json против журнала.
+
+Запуск: python bench_state.py [число_сообщений]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+from state_store import StateJournal
+
+
+def bench_full_rewrite(path, pairs, messages):
+    state = {'last_message_ids': {f'channel_{i}': 1000 for i in range(pairs)}}
+    start = time.perf_counter()
+    for n in range(messages):
+        state['last_message_ids'][f'channel_{n % pairs}'] += 1
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+    return (time.perf_counter() - start) / messages
+
+
+def bench_journal(path, pairs, messages, fsync):
+    store = StateJournal(path, fsync=fsync, compact_every=1000)
+    state = store.load(default={'last_message_ids': {}})
+    state['last_message_ids'] = {f'channel_{i}': 1000 for i in range(pairs)}
+    store.checkpoint(state)
+    start = time.perf_counter()
+    for n in range(messages):
+        source = f'channel_{n % pairs}'
+        state['last_message_ids'][source] += 1
+        store.append('last_message_ids', source, state['last_message_ids'][source])
+        if store.needs_compaction():
+            store.checkpoint(state)
+    elapsed = (time.perf_counter() - start) / messages
+    store.close()
+    return elapsed
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"{'пар':>6} | {'перезапись, мкс':>16} | {'журнал never, мкс':>18} | {'журнал interval, мкс':>21}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for pairs in (1, 10, 100, 1000, 5000):
+            full = bench_full_rewrite(os.path.join(tmp, f'full_{pairs}.json'), pairs, messages)
+            never = bench_journal(os.path.join(tmp, f'never_{pairs}.json'), pairs, messages, 'never')
+            interval = bench_journal(os.path.join(tmp, f'interval_{pairs}.json'), pairs, messages, 'interval')
+            print(f"{pairs:>6} | {full * 1e6:>16.1f} | {never * 1e6:>18.1f} | {interval * 1e6:>21.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,13 @@
+import asyncio
+import logging
 import re
 import os
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DICTIONARY = 'car_brands'
 
 def load_brands_from_file(filename='car_brands.txt'):
     if not os.path.exists(filename):
@@ -7,20 +15,124 @@ def load_brands_from_file(filename='car_brands.txt'):
     with open(filename, 'r', encoding='utf-8') as f:
         return [line.strip() for line in f if line.strip()]
 
-car_brands = load_brands_from_file()
+def _trie_regex(node):
+    """Регулярка из префиксного дерева: ветвление по символу вместо перебора всех брендов"""
+    branches = [re.escape(char) + _trie_regex(child) for char, child in node.items() if char != '']
+    if not branches:
+        return ''
+    body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    if '' in node:
+        # Бренд заканчивается здесь, но жадный ? сначала пробует более длинный (Alfa Romeo раньше Alfa)
+        return '(?:' + body + ')?'
+    return body
+
+def compile_brands(brands):
+    """Один раз собирает список брендов в единую регулярку; возвращает (pattern, lowercase -> бренд)"""
+    lookup = {}
+    trie = {}
+    for brand in brands:
+        key = brand.lower()
+        if key in lookup:
+            continue  # При дублях приоритет у первой записи в файле
+        lookup[key] = brand
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[''] = True
+    pattern = re.compile(r'(?<!\w)(' + _trie_regex(trie) + r')(?!\w)') if trie else None
+    return pattern, lookup
 
 def normalize_tag(brand_name):
     """Преобразует название бренда в безопасный хештег с подчёркиваниями"""
     return re.sub(r'[^a-zA-Z0-9]', '_', brand_name)
 
+
+class BrandDictionary:
+    """Словарь тегов из текстового файла: загружается при первом использовании,
+    хранится в скомпилированном виде и перечитывается при изменении mtime файла.
+
+    Результаты по тексту запоминаются (LRU): одно сообщение проверяется и при
+    выборе способа доставки, и при сборке подписи, и для каждой цели.
+    """
+
+    def __init__(self, path, cache_size=1024):
+        self.path = path if os.path.isabs(path) else os.path.join(BASE_DIR, path)
+        self.mtime = None
+        self.compiled = None  # (pattern, lookup)
+        self.cache_size = cache_size
+        self._found = OrderedDict()  # (текст, limit) -> теги
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Файл {self.path} не найден")
+
+    def _compile(self):
+        return compile_brands(load_brands_from_file(self.path))
+
+    async def refresh(self):
+        """Перечитать файл, если он изменился; чтение и сборка идут в потоке, не блокируя цикл событий"""
+        mtime = self._stat()
+        if mtime == self.mtime:
+            return False
+        compiled = await asyncio.to_thread(self._compile)
+        self.compiled, self.mtime = compiled, mtime
+        self._found.clear()
+        return True
+
+    def find(self, text, limit=3):
+        """До limit нормализованных тегов (один проход по тексту)"""
+        if self.compiled is None:
+            # Первое обращение без предварительного refresh() - синхронная загрузка
+            self.mtime = self._stat()
+            self.compiled = self._compile()
+        key = (text, limit)
+        if key in self._found:
+            self._found.move_to_end(key)
+            return self._found[key]
+        pattern, lookup = self.compiled
+        found = set()
+        if pattern is not None:
+            for match in pattern.finditer(text.lower()):
+                found.add(normalize_tag(lookup[match.group(1)]))
+                if len(found) >= limit:
+                    break
+        self._found[key] = result = sorted(found)
+        if len(self._found) > self.cache_size:
+            self._found.popitem(last=False)
+        return result
+
+
+_dictionaries = {}
+
+def register_dictionary(name, path):
+    """Подключить словарь под именем name (для параметра tag_dictionary пары)"""
+    _dictionaries[name] = BrandDictionary(path)
+
+def get_dictionary(name=DEFAULT_DICTIONARY):
+    """Словарь по имени; незарегистрированное имя ищется в файле <name>.txt рядом с модулем"""
+    if name not in _dictionaries:
+        register_dictionary(name, f'{name}.txt')
+    return _dictionaries[name]
+
+async def refresh_dictionaries():
+    """Проверка mtime всех используемых словарей; возвращает имена перечитанных.
+
+    Ошибка одного файла не мешает остальным: словарь остаётся в последней загруженной версии.
+    """
+    reloaded = []
+    for name, dictionary in list(_dictionaries.items()):
+        try:
+            if await dictionary.refresh():
+                reloaded.append(name)
+        except Exception as e:
+            logger.error(f"Ошибка перезагрузки словаря тегов {name}: {e}")
+    return reloaded
+
+def find_tags(text, dictionary=DEFAULT_DICTIONARY, limit=3):
+    return get_dictionary(dictionary).find(text, limit)
+
 def find_car_brands(text):
-    """Возвращает список до 3 нормализованных хештегов брендов"""
-    found = set()
-    text_lower = text.lower()
-    for brand in car_brands:
-        if re.search(rf'\b{re.escape(brand.lower())}\b', text_lower):
-            tag = f"{normalize_tag(brand)}"
-            found.add(tag)
-        if len(found) >= 3:
-            break
-    return sorted(found)
+    """Возвращает список до 3 нормализованных хештегов брендов (один проход по тексту)"""
+    return find_tags(text, DEFAULT_DICTIONARY)
@@ -0,0 +1,51 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Debouncer:
+    """Слияние серии событий по ключу: действие выполняется один раз через window сек после последнего.
+
+    Каждое новое событие ключа переносит срок; значение заменяется новым или
+    объединяется со старым через merge(old, new). action(key, value) -
+    корутинная функция, её ошибки пишутся в лог.
+    """
+
+    def __init__(self, window, action, merge=None):
+        self.window = window
+        self.action = action
+        self.merge = merge
+        self._pending = {}  # key -> [TimerHandle, значение]
+        self._tasks = set()
+
+    def push(self, key, value):
+        entry = self._pending.get(key)
+        if entry is not None:
+            entry[0].cancel()
+            if self.merge is not None:
+                value = self.merge(entry[1], value)
+        handle = asyncio.get_running_loop().call_later(self.window, self._fire, key)
+        self._pending[key] = [handle, value]
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _fire(self, key):
+        _, value = self._pending.pop(key)
+        task = asyncio.create_task(self._run(key, value))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, value):
+        try:
+            await self.action(key, value)
+        except Exception as e:
+            logger.error(f"Ошибка обработки {key}: {str(e)[:200]}...")
+
+    def cancel(self):
+        for handle, _ in self._pending.values():
+            handle.cancel()
+        self._pending.clear()
+        for task in self._tasks:
+            task.cancel()
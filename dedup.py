@@ -0,0 +1,151 @@
+import logging
+import math
+import sqlite3
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def sqlite_path_from_url(url):
+    """sqlite:///copier.db -> copier.db"""
+    prefix = 'sqlite:///'
+    if not url.startswith(prefix):
+        raise ValueError(f"Поддерживается только sqlite: {url}")
+    return url[len(prefix):]
+
+
+class BloomFilter:
+    """Фильтр Блума фиксированного размера поверх bytearray"""
+
+    def __init__(self, capacity, error_rate=0.01, bits=None):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bits if bits is not None and len(bits) == (self.size + 7) // 8 \
+            else bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Двойное хеширование поверх md5-хеша сообщения
+        value = int(key, 16)
+        h1, h2 = value & 0xFFFFFFFFFFFFFFFF, (value >> 64) | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class DedupIndex:
+    """Дисковый индекс хешей уже скопированных сообщений.
+
+    Позитивные проверки обслуживает LRU-кеш в памяти, негативные - фильтр Блума,
+    который сохраняется в базе при штатной остановке. В sqlite идём только
+    при «может быть» от фильтра.
+    """
+
+    def __init__(self, path, retention_days=30, max_entries=100000, cache_size=10000, prune_every=1000):
+        self.retention = retention_days * 86400 if retention_days > 0 else None
+        self.max_entries = max_entries
+        self._bloom_capacity = max_entries if max_entries > 0 else 100000
+        self.cache_size = min(cache_size, max_entries) if max_entries > 0 else cache_size
+        self.prune_every = prune_every
+        self._cache = OrderedDict()
+        self._added = 0
+        self._added_since_rebuild = 0
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS message_hashes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            hash TEXT NOT NULL UNIQUE,
+            created REAL NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS ix_message_hashes_created ON message_hashes(created)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS dedup_meta (key TEXT PRIMARY KEY, value BLOB)')
+        self._load_bloom()
+
+    def _load_bloom(self):
+        """Фильтр читается целиком одним блобом - время старта не зависит от числа хешей"""
+        meta = dict(self.db.execute('SELECT key, value FROM dedup_meta'))
+        bits = meta.get('bloom')
+        self.bloom = BloomFilter(self._bloom_capacity, bits=bytearray(bits) if bits else None)
+        # Если прошлый запуск завершился аварийно, в фильтре могут не хватать хешей
+        self._bloom_valid = meta.get('clean') == 1 and bits is not None and len(bits) == len(self.bloom.bits)
+        if not self._bloom_valid and self._has_rows():
+            logger.warning("Фильтр Блума дедупликации не был сохранён, до перестроения проверки идут в базу")
+        elif not self._bloom_valid:
+            self._bloom_valid = True
+        self.db.execute("INSERT OR REPLACE INTO dedup_meta (key, value) VALUES ('clean', 0)")
+        self.db.commit()
+
+    def _has_rows(self):
+        return self.db.execute('SELECT 1 FROM message_hashes LIMIT 1').fetchone() is not None
+
+    def __contains__(self, message_hash):
+        if message_hash in self._cache:
+            self._cache.move_to_end(message_hash)
+            return True
+        if self._bloom_valid and message_hash not in self.bloom:
+            return False
+        row = self.db.execute('SELECT 1 FROM message_hashes WHERE hash = ?', (message_hash,)).fetchone()
+        if row:
+            self._remember(message_hash)
+        return row is not None
+
+    def add(self, message_hash):
+        self.db.execute('INSERT OR IGNORE INTO message_hashes (hash, created) VALUES (?, ?)',
+                        (message_hash, time.time()))
+        self.db.commit()
+        self.bloom.add(message_hash)
+        self._remember(message_hash)
+        self._added += 1
+        self._added_since_rebuild += 1
+        if self._added % self.prune_every == 0:
+            self.prune()
+
+    def _remember(self, message_hash):
+        self._cache[message_hash] = True
+        self._cache.move_to_end(message_hash)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def prune(self):
+        """Удаление хешей за пределами окна хранения (по возрасту и по количеству)"""
+        removed = 0
+        if self.retention:
+            removed += self.db.execute('DELETE FROM message_hashes WHERE created < ?',
+                                       (time.time() - self.retention,)).rowcount
+        if self.max_entries > 0:
+            last_id = self.db.execute('SELECT MAX(id) FROM message_hashes').fetchone()[0] or 0
+            removed += self.db.execute('DELETE FROM message_hashes WHERE id <= ?',
+                                       (last_id - self.max_entries,)).rowcount
+        self.db.commit()
+        if removed:
+            self._cache.clear()  # Удалённые хеши не должны находиться через кеш; нужные вернутся из базы
+            logger.info(f"Удалено {removed} устаревших хешей из индекса дедупликации")
+
+        # Удалённые хеши остаются в фильтре; перестраиваем его, когда он «переполнен» или невалиден
+        if not self._bloom_valid or self._added_since_rebuild >= self._bloom_capacity:
+            self._rebuild_bloom()
+
+    def _rebuild_bloom(self):
+        bloom = BloomFilter(self._bloom_capacity)
+        for (message_hash,) in self.db.execute('SELECT hash FROM message_hashes'):
+            bloom.add(message_hash)
+        self.bloom = bloom
+        self._bloom_valid = True
+        self._added_since_rebuild = 0
+
+    def close(self):
+        if self.db is None:
+            return
+        self.db.execute("INSERT OR REPLACE INTO dedup_meta (key, value) VALUES ('bloom', ?)",
+                        (bytes(self.bloom.bits),))
+        self.db.execute("INSERT OR REPLACE INTO dedup_meta (key, value) VALUES ('clean', ?)",
+                        (1 if self._bloom_valid else 0,))
+        self.db.commit()
+        self.db.close()
+        self.db = None
@@ -0,0 +1,79 @@
+import logging
+import sqlite3
+import time
+
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerSelf, InputPeerUser
+
+logger = logging.getLogger(__name__)
+
+
+class EntityCache:
+    """Постоянный кеш name -> InputPeer для источников и целей.
+
+    Имена из конфига (username, ссылка или название) разрешаются один раз,
+    результат хранится в sqlite и переживает перезапуск, так что горячий путь
+    не тратит лимитированные ResolveUsername.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS entities (
+            name TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            peer_id INTEGER NOT NULL,
+            access_hash INTEGER NOT NULL,
+            updated REAL NOT NULL)''')
+        self.db.commit()
+        self.peers = {}
+        for name, kind, peer_id, access_hash in self.db.execute(
+                'SELECT name, kind, peer_id, access_hash FROM entities'):
+            self.peers[name] = self._to_peer(kind, peer_id, access_hash)
+
+    async def resolve(self, client, name):
+        """InputPeer для имени: из кеша или одним запросом к Telegram с сохранением"""
+        peer = self.peers.get(name)
+        if peer is not None:
+            return peer
+
+        peer = await client.get_input_entity(name)
+        kind, peer_id, access_hash = self._from_peer(peer)
+        self.db.execute('INSERT OR REPLACE INTO entities (name, kind, peer_id, access_hash, updated) '
+                        'VALUES (?, ?, ?, ?, ?)', (name, kind, peer_id, access_hash, time.time()))
+        self.db.commit()
+        self.peers[name] = peer
+        logger.info(f"Разрешён {name} -> {kind} {peer_id}")
+        return peer
+
+    def invalidate(self, name):
+        """Сброс записи после ChannelInvalid/PeerIdInvalid - при следующем обращении имя разрешится заново"""
+        if self.peers.pop(name, None) is not None:
+            self.db.execute('DELETE FROM entities WHERE name = ?', (name,))
+            self.db.commit()
+            logger.warning(f"Кеш сущности {name} сброшен")
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    @staticmethod
+    def _from_peer(peer):
+        if isinstance(peer, InputPeerChannel):
+            return 'channel', peer.channel_id, peer.access_hash
+        if isinstance(peer, InputPeerUser):
+            return 'user', peer.user_id, peer.access_hash
+        if isinstance(peer, InputPeerChat):
+            return 'chat', peer.chat_id, 0
+        if isinstance(peer, InputPeerSelf):
+            return 'self', 0, 0
+        raise ValueError(f"Неподдерживаемый тип сущности: {type(peer).__name__}")
+
+    @staticmethod
+    def _to_peer(kind, peer_id, access_hash):
+        if kind == 'channel':
+            return InputPeerChannel(peer_id, access_hash)
+        if kind == 'user':
+            return InputPeerUser(peer_id, access_hash)
+        if kind == 'chat':
+            return InputPeerChat(peer_id)
+        return InputPeerSelf()
@@ -0,0 +1,148 @@
+import re
+from collections import deque
+
+INCLUDE = 1
+REQUIRED = 2
+EXCLUDED = 4
+
+# До этого числа ключевых слов перебор через str.__contains__ (на C) быстрее автомата на Python
+AUTOMATON_THRESHOLD = 200
+
+
+class AhoCorasick:
+    """Автомат Ахо-Корасик: поиск всех шаблонов за один проход по тексту"""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        for index, pattern in enumerate(patterns):
+            self._add(pattern, index)
+        self._build()
+
+    def _add(self, pattern, index):
+        state = 0
+        for char in pattern:
+            nxt = self.goto[state].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][char] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+            state = nxt
+        self.out[state] += (index,)
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self.goto[state].items():
+                queue.append(nxt)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[nxt] = self.goto[fallback].get(char, 0)
+                # Совпадения суффиксов наследуются, чтобы не ходить по fail-ссылкам при поиске
+                self.out[nxt] += self.out[self.fail[nxt]]
+
+    def iter_matches(self, text):
+        """Индексы найденных шаблонов (возможны повторы) в порядке появления"""
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                yield from out[state]
+
+
+class SubstringMatcher:
+    """Перебор подстрок для небольших списков ключевых слов; интерфейс как у AhoCorasick"""
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+
+    def iter_matches(self, text):
+        return (index for index, pattern in enumerate(self.patterns) if pattern in text)
+
+
+class MessageFilter:
+    """Фильтр пары, собранный один раз при загрузке конфига.
+
+    Все ключевые слова (filter_keywords, required_keywords, excluded_keywords)
+    ищутся одним автоматом за один проход по тексту (для коротких списков -
+    перебором подстрок), регулярки объединены в одну.
+    Сравнение без учёта регистра, ключевые слова ищутся как подстроки.
+    """
+
+    def __init__(self, keywords=(), required=(), excluded=(), regex=None, allow_empty=True):
+        kinds = {}
+        for words, kind in ((keywords, INCLUDE), (required, REQUIRED), (excluded, EXCLUDED)):
+            for word in words:
+                word = word.casefold()
+                kinds[word] = kinds.get(word, 0) | kind
+        self.patterns = list(kinds)
+        self.kinds = [kinds[p] for p in self.patterns]
+        self.required_count = sum(1 for k in self.kinds if k & REQUIRED)
+        self.has_include = any(k & INCLUDE for k in self.kinds)
+        self.has_excluded = any(k & EXCLUDED for k in self.kinds)
+        self.matcher = None
+        if self.patterns:
+            matcher_cls = AhoCorasick if len(self.patterns) > AUTOMATON_THRESHOLD else SubstringMatcher
+            self.matcher = matcher_cls(self.patterns)
+        self.regex = self._combine(regex) if regex else None
+        self.allow_empty = allow_empty
+
+    @staticmethod
+    def _combine(regexes):
+        if isinstance(regexes, str):
+            regexes = [regexes]
+        return re.compile('|'.join(f'(?:{r})' for r in regexes), re.IGNORECASE)
+
+    @property
+    def empty(self) -> bool:
+        return self.matcher is None and self.regex is None and self.allow_empty
+
+    def matches(self, text) -> bool:
+        if not text:
+            return self.allow_empty
+
+        if self.matcher is not None:
+            included = not self.has_include
+            required = set()
+            for index in self.matcher.iter_matches(text.casefold()):
+                kind = self.kinds[index]
+                if kind & EXCLUDED:
+                    return False
+                if kind & INCLUDE:
+                    included = True
+                if kind & REQUIRED:
+                    required.add(index)
+                if included and not self.has_excluded and len(required) == self.required_count:
+                    break  # Исход уже известен - дочитывать текст незачем
+            if not included or len(required) < self.required_count:
+                return False
+
+        return self.regex is None or self.regex.search(text) is not None
+
+
+def split_keywords(raw):
+    return [kw.strip() for kw in (raw or '').split(',') if kw.strip()]
+
+
+def build_filter(cfg):
+    """MessageFilter из секции [ChannelPair:*]; filter_mode = simple учитывает только filter_keywords"""
+    keywords = split_keywords(cfg.get('filter_keywords'))
+    if cfg.get('filter_mode', 'advanced').strip().lower() == 'simple':
+        return MessageFilter(keywords)
+
+    regexes = [line.strip() for line in (cfg.get('regex_filter') or '').splitlines() if line.strip()]
+    return MessageFilter(
+        keywords,
+        required=split_keywords(cfg.get('required_keywords')),
+        excluded=split_keywords(cfg.get('excluded_keywords')),
+        regex=regexes or None,
+        allow_empty=cfg.getboolean('allow_empty', fallback=True)
+    )
@@ -0,0 +1,124 @@
+import logging
+import time
+from contextlib import asynccontextmanager
+from datetime import timedelta
+
+from telethon import errors
+
+logger = logging.getLogger(__name__)
+
+# Ошибки самой takeout-сессии; остальные (канал закрыт, неверный id) относятся к источнику, и обычное чтение их не обойдёт
+TAKEOUT_ERRORS = (errors.TakeoutInvalidError, errors.TakeoutRequiredError, errors.TakeoutInitDelayError)
+
+
+class HistoryReader:
+    """Чтение истории источника по возрастанию id.
+
+    Telethon сам делит выборку на страницы по 100 сообщений; встроенная пауза
+    между страницами (wait_time) отключена - темп задают ограничитель и FloodWait.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def iter_messages(self, peer, min_id=0, max_id=0, offset_date=None):
+        return self.client.iter_messages(peer, min_id=min_id, max_id=max_id, offset_date=offset_date,
+                                         reverse=True, wait_time=0)
+
+
+class TakeoutHistoryReader(HistoryReader):
+    """Чтение истории через takeout-сессию (экспорт данных) с заметно более высокими лимитами.
+
+    Если сессия перестаёт приниматься посреди чтения, выборка продолжается
+    обычным чтением с последнего выданного id.
+    """
+
+    def __init__(self, takeout, fallback):
+        super().__init__(takeout)
+        self.fallback = fallback
+        self.active = True
+
+    async def iter_messages(self, peer, min_id=0, max_id=0, offset_date=None):
+        if self.active:
+            try:
+                async for message in super().iter_messages(peer, min_id, max_id, offset_date):
+                    min_id = message.id
+                    yield message
+                return
+            except TAKEOUT_ERRORS as e:
+                logger.warning(f"Takeout-сессия отклонена ({e.__class__.__name__}), продолжаем обычным чтением")
+                self.active = False
+        async for message in self.fallback.iter_messages(peer, min_id, max_id, offset_date):
+            yield message
+
+
+@asynccontextmanager
+async def open_history_reader(client, use_takeout=False):
+    """Читатель истории: takeout-сессия, если включена и Telegram её открыл, иначе обычное чтение"""
+    fallback = HistoryReader(client)
+    if not use_takeout:
+        yield fallback
+        return
+
+    session = client.takeout(finalize=True, chats=True, megagroups=True, channels=True)
+    takeout = None
+    try:
+        takeout = await session.__aenter__()
+    except errors.TakeoutInitDelayError as e:
+        logger.warning(f"Takeout-сессию нужно подтвердить в другом клиенте Telegram (повтор через {e.seconds} сек), "
+                       f"история читается обычным способом")
+    except errors.RPCError as e:
+        logger.warning(f"Takeout-сессия не открыта ({e.__class__.__name__}), история читается обычным способом")
+    if takeout is None:
+        yield fallback
+        return
+
+    logger.info("История читается через takeout-сессию")
+    try:
+        yield TakeoutHistoryReader(takeout, fallback)
+    except BaseException as e:
+        # Незавершённый экспорт закрывается как неуспешный
+        await session.__aexit__(type(e), e, e.__traceback__)
+        raise
+    else:
+        await session.__aexit__(None, None, None)
+
+
+class BackfillProgress:
+    """Прогресс копирования истории источника: доля диапазона id, скорость и оценка оставшегося времени.
+
+    job - запись чекпоинта {'start', 'cursor', 'until', 'since'}; id в канале
+    идут подряд, так что диапазон id - хорошая оценка числа сообщений.
+    """
+
+    def __init__(self, job, report_interval=60):
+        self.job = job
+        self.report_interval = report_interval
+        self.started = time.monotonic()
+        self.started_cursor = job['cursor']
+        self.reported = self.started
+
+    def advance(self, message_id):
+        if self.job['cursor'] == self.job['start'] == self.started_cursor and message_id > self.job['start'] + 1:
+            # Первое сообщение после даты отсечения: диапазон начинается отсюда
+            self.job['start'] = self.started_cursor = message_id - 1
+        self.job['cursor'] = message_id
+
+    @property
+    def done(self) -> bool:
+        return self.job['cursor'] >= self.job['until']
+
+    def report_due(self) -> bool:
+        now = time.monotonic()
+        if now - self.reported < self.report_interval:
+            return False
+        self.reported = now
+        return True
+
+    def summary(self) -> str:
+        job = self.job
+        total = max(job['until'] - job['start'], 1)
+        copied = job['cursor'] - job['start']
+        rate = (job['cursor'] - self.started_cursor) / max(time.monotonic() - self.started, 1e-6)
+        eta = f"{timedelta(seconds=int((job['until'] - job['cursor']) / rate))}" if rate > 0 else "-"
+        return f"{copied * 100 // total}% ({copied}/{total}), {rate * 60:.0f} сообщ./мин, осталось ~{eta}"
@@ -1,18 +1,32 @@
 import asyncio
+import base64
 import configparser
 import hashlib
 import html
-import json
 import logging
 import os
 import re
-from datetime import datetime, timedelta
-from brands import find_car_brands
-from typing import List
+import time
+from datetime import datetime, timedelta, timezone
+from albums import Album, complete_album, group_albums
+from brands import find_car_brands, find_tags, get_dictionary, refresh_dictionaries, register_dictionary
+from debounce import Debouncer
+from dedup import DedupIndex, sqlite_path_from_url
+from entity_cache import EntityCache
+from filters import build_filter, split_keywords
+from history import BackfillProgress, open_history_reader
+from media_cache import MediaCache
+from media_pipe import SMALL_FILE_LIMIT, transcode_upload, upload_stream
+from message_map import MessageMap
+from outbox import Outbox
+from rate_limiter import DeferredQueue, RateLimiter
+from scheduler import PostScheduler, ScheduledPost
+from state_store import StateJournal
+from transcoder import PRIORITY_HISTORY, PRIORITY_LIVE, TranscodePool, transcode_key
 
 import telethon
 # from aiohttp import web
-from telethon import TelegramClient, errors
+from telethon import TelegramClient, errors, events, utils
 from telethon.tl.patched import MessageService
 from telethon.tl.types import (
     MessageMediaPhoto,
@@ -21,8 +35,12 @@ from telethon.tl.types import (
     MessageMediaGeo,
     MessageMediaWebPage,
     InputMediaDice,
+    InputPhoto,
+    InputDocument,
 )
 
+FORWARD_BATCH_SIZE = 100  # Максимум id в одном запросе пересылки
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -49,21 +67,95 @@ class TelegramChannelCopier:
         self.post_interval = int(self.config.get('Settings', 'post_interval', fallback=0)) * 60
         self.check_interval = int(self.config.get('Settings', 'check_interval', fallback=10)) * 60
 
-        self.scheduled_posts = asyncio.Queue()  # Очередь для отложенных постов
+        self.scheduled_posts = PostScheduler()  # Отложенные посты по времени публикации
         self.next_post_time = None  # Время следующего поста
-        self.message_hashes = set()  # Для хранения хешей сообщений
+        self.db_path = sqlite_path_from_url(self.config.get('Database', 'url', fallback='sqlite:///copier.db'))
+        self.entities = EntityCache(self.db_path)  # Разрешённые InputPeer источников и целей
+        self.message_hashes = DedupIndex(  # Хеши скопированных сообщений (переживают перезапуск)
+            self.db_path,
+            retention_days=int(self.config.get('Settings', 'dedup_retention_days', fallback=30)),
+            max_entries=int(self.config.get('Settings', 'dedup_max_entries', fallback=100000)),
+            cache_size=int(self.config.get('Settings', 'dedup_cache_size', fallback=10000))
+        )
+        self.media_cache = MediaCache(  # Ссылки на уже загруженные файлы - загрузка одна на все цели
+            self.db_path,
+            max_age_days=int(self.config.get('Settings', 'media_cache_days', fallback=7)),
+            max_bytes=int(self.config.get('Settings', 'media_cache_mb', fallback=2048)) * 1024 * 1024
+        )
+        self.transcoder = TranscodePool(  # Сжатие видео: не больше transcode_workers ffmpeg одновременно
+            workers=int(self.config.get('Settings', 'transcode_workers', fallback=0)) or None,
+            timeout=int(self.config.get('Settings', 'transcode_timeout', fallback=1800))
+        )
+        # Видео больше этого размера сжимаются перед отправкой (0 - отправляются как есть)
+        self.compress_video_bytes = int(self.config.get('Settings', 'compress_video_mb', fallback=0)) * 1024 * 1024
+        self.outbox = Outbox(  # Записи о доставке каждого сообщения: досылка после сбоя без дублей
+            self.db_path,
+            retention_days=int(self.config.get('Settings', 'outbox_retention_days', fallback=30)),
+            max_attempts=int(self.config.get('Settings', 'outbox_max_attempts', fallback=5))
+        )
+        self.outbox_retry_after = int(self.config.get('Settings', 'outbox_retry_after', fallback=600))
+        self.outbox_checked = 0.0  # Время последней досылки незавершённых записей
+        self.message_map = MessageMap(  # id в источнике -> id копии в цели (правки, удаления, ответы)
+            self.db_path,
+            cache_size=int(self.config.get('Settings', 'message_map_cache_size', fallback=10000))
+        )
+        # Правки и удаления в источниках повторяются в целях по обновлениям Telegram
+        self.mirror_edits = self.config.getboolean('Settings', 'mirror_edits', fallback=True)
+        self.mirror_deletes = self.config.getboolean('Settings', 'mirror_deletes', fallback=False)
+        mirror_debounce = float(self.config.get('Settings', 'mirror_debounce', fallback=3))
+        self.edit_debouncer = Debouncer(mirror_debounce, self._mirror_edit)  # Серия правок -> одна последняя
+        self.delete_debouncer = Debouncer(mirror_debounce, self._mirror_delete, merge=set.union)
         self.max_retries = 3  # Максимальное количество попыток повтора
         self.retry_delay = 60  # Задержка между попытками в секундах
         self.state_file = self.config.get('Settings', 'state_file', fallback='state.json')
+        self.state_store = StateJournal(
+            self.state_file,
+            fsync=self.config.get('Settings', 'state_fsync', fallback='interval'),
+            fsync_interval=float(self.config.get('Settings', 'state_fsync_interval', fallback=1)),
+            compact_every=int(self.config.get('Settings', 'state_compact_every', fallback=1000))
+        )
         self.copy_history_days = int(self.config.get('Settings', 'copy_history_days', fallback=0))
+        # История копируется фоновыми задачами параллельно с новыми сообщениями
+        self.history_semaphore = asyncio.Semaphore(
+            int(self.config.get('Settings', 'history_concurrency', fallback=2)))
+        self.history_prefetch = int(self.config.get('Settings', 'history_prefetch', fallback=500))
+        self.history_takeout = self.config.getboolean('Settings', 'history_takeout', fallback=False)
+        self.history_task = None
+        if 'Dictionaries' in self.config:
+            # Именованные словари тегов: имя = путь (относительный - от каталога программы)
+            for name, path in self.config['Dictionaries'].items():
+                register_dictionary(name, path)
+        self.dictionary_check_interval = int(self.config.get('Settings', 'dictionary_check_interval', fallback=30))
         self.channel_pairs = self._parse_channel_pairs()
+        self.routes = self._build_routes(self.channel_pairs)
+        # Общий бюджет одновременно обрабатываемых источников
+        self.pair_semaphore = asyncio.Semaphore(
+            int(self.config.get('Settings', 'max_concurrent_pairs', fallback=10)))
+        self.pair_stats = {}  # Статистика и задержка доставки по парам
+        self.rate_limiter = RateLimiter(
+            global_rate=int(self.config.get('Settings', 'rate_limit_global', fallback=60)),
+            target_rate=int(self.config.get('Settings', 'rate_limit_per_target', fallback=20))
+        )
+        for pair in self.channel_pairs:
+            if pair['rate_limit']:
+                self.rate_limiter.configure(pair['target'], pair['rate_limit'])
+        self.deferred = DeferredQueue(self.rate_limiter)  # Сообщения для целей под штрафом FloodWait
+        self.source_locks = {}  # Сериализация обработки внутри одного источника
+        self.scheduler_task = None
+        self.dictionary_task = None
+        self.scheduled_until = {}  # Максимальный запланированный id по паре (delayed)
+        self.message_cache = {}  # (peer, id) -> (сообщение, время загрузки) для наступивших постов
+        self.message_cache_ttl = int(self.config.get('Settings', 'rehydrate_cache_ttl', fallback=120))
+        self.seen_message_ids = {}  # Последний увиденный id по источнику (для поиска пропусков в realtime)
+        self.sources_by_peer_id = {}  # peer id источника -> имена источников из конфига (realtime)
+        self.reconnect_check_interval = 5
         self.running = False
         # self.web_port = int(self.config.get('Web', 'port', fallback=8080))
         self.state = self._load_state()
-        self.media_albums = {}  # Для хранения альбомов
 
     def _load_config(self, config_file):
-        config = configparser.ConfigParser()
+        # Комментарии после значения (`key = value  ; пояснение`), как в config.ini.example
+        config = configparser.ConfigParser(inline_comment_prefixes=(';',))
         try:
             # Пробуем UTF-8 сначала
             with open(config_file, 'r', encoding='utf-8') as f:
@@ -88,48 +180,108 @@ class TelegramChannelCopier:
             if not section.startswith('ChannelPair:'):
                 continue
             cfg = self.config[section]
-            source = cfg.get('source') or cfg.get('source_channel')
-            target = cfg.get('target') or cfg.get('target_channel')
-            raw = cfg.get('filter_keywords', '')
-            keywords = [kw.strip() for kw in raw.split(',') if kw.strip()]
+            # source и target могут быть списками через запятую: секция задаёт маршрут из каждого
+            # источника в каждую цель, все маршруты секции делят один фильтр
+            sources = split_keywords(cfg.get('source') or cfg.get('source_channel'))
+            targets = split_keywords(cfg.get('target') or cfg.get('target_channel'))
+            keywords = split_keywords(cfg.get('filter_keywords', ''))
             tag = cfg.getboolean('tag', fallback=False)
-            pairs.append({
-                'source': source,
-                'target': target,
-                'filter_keywords': keywords,
-                'tag': tag,
-                'name': section.replace('ChannelPair:', '')
-            })
-            return pairs
+            message_filter = build_filter(cfg)  # Собирается один раз, см. filters.MessageFilter
+            name = section.replace('ChannelPair:', '')
+            for source in sources:
+                for target in targets:
+                    pairs.append({
+                        'source': source,
+                        'target': target,
+                        'filter_keywords': keywords,
+                        'filter': message_filter,
+                        'tag': tag,
+                        'tag_dictionary': cfg.get('tag_dictionary', fallback='car_brands'),  # Имя словаря тегов
+                        'rate_limit': cfg.getint('rate_limit', fallback=None),  # Сообщений в минуту в target
+                        # copy - отправка копий по одной, batch_forward - пересылка пачками без автора
+                        'copy_strategy': cfg.get('copy_strategy', fallback=self.config.get(
+                            'Settings', 'copy_strategy', fallback='copy')).strip().lower(),
+                        'name': name if len(sources) == len(targets) == 1 else f"{name}:{source}->{target}"
+                    })
+        return pairs
+
+    @staticmethod
+    def _build_routes(pairs):
+        """Источник -> его пары (маршруты): каждый источник читается один раз на все цели"""
+        routes = {}
+        for pair in pairs:
+            routes.setdefault(pair['source'], []).append(pair)
+        return routes
 
     def _save_state(self):
-        """Сохранение состояния с очередью сообщений"""
+        """Сохранение полного снимка состояния с очередью сообщений (компактификация журнала)"""
         state = {
             'last_message_ids': self.state['last_message_ids'],
-            'scheduled_posts': list(self.scheduled_posts._queue),  # Сохраняем всю очередь
+            'route_message_ids': self.state['route_message_ids'],
+            'history': self.state['history'],
+            'scheduled_posts': {post.key: post.to_list() for post in self.scheduled_posts.posts()},
             'next_post_time': self.next_post_time.isoformat() if self.next_post_time else None
         }
-        with open(self.state_file, 'w', encoding='utf-8') as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
-
-    def _load_state(self):
-        """Загрузка состояния с восстановлением очереди"""
         try:
-            with open(self.state_file, 'r', encoding='utf-8') as f:
-                state = json.load(f)
+            self.state_store.checkpoint(state)
+        except Exception as e:
+            # Журнал остаётся валидным, предыдущий снимок не тронут
+            logger.error(f"Ошибка записи снимка состояния: {e}")
 
-                # Восстанавливаем очередь
-                self.scheduled_posts = asyncio.Queue()
-                for post in state.get('scheduled_posts', []):
-                    self.scheduled_posts.put_nowait(post)
+    def _set_last_message_id(self, source, message_id):
+        """Запись прогресса по источнику: дельта в журнал вместо перезаписи всего файла"""
+        if message_id <= self.state['last_message_ids'].get(source, 0):
+            return
+        self.state['last_message_ids'][source] = message_id
+        self._journal('last_message_ids', source, message_id)
 
-                # Восстанавливаем время следующего поста
-                if state.get('next_post_time'):
-                    self.next_post_time = datetime.fromisoformat(state['next_post_time'])
+    def _journal(self, section, key, value):
+        """Дельта state[section][key] в журнал; разросшийся журнал сворачивается в снимок"""
+        self.state_store.append(section, key, value)
+        if self.state_store.needs_compaction():
+            self._save_state()
+
+    def _route_cursor(self, pair):
+        return self.state['route_message_ids'].get(pair['name'], self.state['last_message_ids'].get(pair['source'], 0))
 
-                return state
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {'last_message_ids': {}}
+    def _advance_route(self, pair, message_id):
+        """Прогресс пары; курсор источника - минимум по его парам, чтобы отстающая цель ничего не потеряла"""
+        routes = self.routes.get(pair['source'], [pair])
+        if len(routes) == 1:
+            self._set_last_message_id(pair['source'], message_id)
+            return
+        if message_id <= self._route_cursor(pair):
+            return
+        self.state['route_message_ids'][pair['name']] = message_id
+        self._journal('route_message_ids', pair['name'], message_id)
+        self._set_last_message_id(pair['source'], min(self._route_cursor(route) for route in routes))
+
+    def _load_state(self):
+        """Загрузка состояния с восстановлением очереди"""
+        state = self.state_store.load(default={'last_message_ids': {}})
+        state.setdefault('last_message_ids', {})
+        state.setdefault('route_message_ids', {})  # Курсоры пар, делящих один источник
+        state.setdefault('history', {})  # Чекпоинты копирования истории по источникам
+
+        # Восстанавливаем очередь
+        self.scheduled_posts = PostScheduler()
+        saved_posts = state.get('scheduled_posts') or {}
+        if isinstance(saved_posts, list):
+            # Старый формат хранил живые объекты сообщений и не восстанавливался
+            logger.warning(f"Пропущено {len(saved_posts)} отложенных постов в устаревшем формате")
+            saved_posts = {}
+        for data in saved_posts.values():
+            post = ScheduledPost.from_list(data)
+            self.scheduled_posts.push(post, post.target, post.due)
+            self.scheduled_until[post.pair] = max(self.scheduled_until.get(post.pair, 0), post.message_id)
+        if saved_posts:
+            logger.info(f"Восстановлено {len(saved_posts)} отложенных постов")
+
+        # Восстанавливаем время следующего поста
+        if state.get('next_post_time'):
+            self.next_post_time = datetime.fromisoformat(state['next_post_time'])
+
+        return state
 
     async def _check_bot_permissions(self):
         """Проверка прав с уточнением типа канала"""
@@ -171,9 +323,9 @@ class TelegramChannelCopier:
                 return False
         return True
 
-    def _generate_message_hash(self, message) -> str:
-        """Генерация уникального хеша для сообщения"""
-        content = str(message.id) + str(message.date) + (message.text or "")
+    def _generate_message_hash(self, message, target) -> str:
+        """Генерация уникального хеша для сообщения в конкретной цели"""
+        content = str(target) + str(message.id) + str(message.date) + (message.text or "")
         if message.media:
             if hasattr(message.media, 'document'):
                 content += str(message.media.document.id)
@@ -184,13 +336,13 @@ class TelegramChannelCopier:
         """Обработка сообщения с автоматическим повтором при ошибках"""
         for attempt in range(self.max_retries):
             try:
-                message_hash = self._generate_message_hash(message)
+                message_hash = self._generate_message_hash(message, target)
                 if message_hash in self.message_hashes:
                     logger.info(f"Сообщение {message.id} уже было скопировано ранее (дубликат)")
                     return True
 
-                if hasattr(message, 'grouped_id') and message.grouped_id:
-                    await self._handle_album(message, target)
+                if isinstance(message, Album):
+                    await self._send_album(message, target, pair)
                 else:
                     await self._copy_single_message(message, target, pair)
 
@@ -210,115 +362,327 @@ class TelegramChannelCopier:
                     return False
         return False
 
-    async def _process_message_with_retry(self, message, target, pair):
-        """Обработка сообщения с автоматическим повтором при ошибках + фильтрация пустых и системных сообщений"""
+    async def _process_message_with_retry(self, message, target, pair, on_delivered=None, wait_flood=True,
+                                          resumed=False, priority=PRIORITY_LIVE):
+        """Обработка сообщения с автоматическим повтором при ошибках + фильтрация пустых и системных сообщений
+
+        on_delivered - если задан, при FloodWait сообщение откладывается в очередь цели и возвращается False,
+        а on_delivered() вызывается после фактической отправки. wait_flood=False - просто вернуть False.
+        """
         # Фильтрация системных сообщений
         from telethon.tl.patched import MessageService
         if isinstance(message, MessageService):
             logger.info(f"Пропущено системное сообщение {message.id}")
+            self.outbox.complete(pair['name'], message.id)
             return True
 
         # Фильтрация пустых сообщений (без текста и медиа)
         if not getattr(message, "text", None) and not getattr(message, "media", None):
             logger.warning(f"Сообщение {message.id} пустое, пропускаем")
+            self.outbox.complete(pair['name'], message.id)
+            return True
+
+        if self.outbox.delivered(pair['name'], message.id):
+            logger.info(f"Сообщение {message.id} уже доставлено в {target}")
             return True
 
+        # Цель под штрафом: встаём в её очередь, чтобы сохранить порядок и не держать пару
+        if on_delivered and not resumed and (target in self.deferred or self.rate_limiter.is_blocked(target)):
+            self._park(message, target, pair, on_delivered)
+            return False
+
         for attempt in range(self.max_retries):
             try:
-                message_hash = self._generate_message_hash(message)
+                message_hash = self._generate_message_hash(message, target)
                 if message_hash in self.message_hashes:
                     logger.info(f"Сообщение {message.id} уже было скопировано ранее (дубликат)")
+                    self.outbox.complete(pair['name'], message.id)
                     return True
 
-                if hasattr(message, 'grouped_id') and message.grouped_id:
-                    await self._handle_album(message, target)
+                peer = await self._peer(target)
+                # Темп отправки задаёт ограничитель, а не фиксированные паузы
+                await self.rate_limiter.acquire(target)
+                if isinstance(message, Album):
+                    sent = await self._send_album(message, peer, pair)
                 else:
-                    await self._copy_single_message(message, target, pair)
+                    sent = await self._copy_single_message(message, peer, pair, priority)
+                if not sent:
+                    # Не удались ни копия, ни пересылка - запись outbox остаётся незавершённой
+                    return False
 
                 self.message_hashes.add(message_hash)
+                self.outbox.complete(pair['name'], message.id, self._sent_id(sent))
+                await self._map_sent(pair, message.ids if isinstance(message, Album) else [message.id], sent)
+                self.rate_limiter.on_success(target)
                 return True
 
             except errors.FloodWaitError as e:
                 wait_time = e.seconds + 10
+                self.rate_limiter.on_flood_wait(target, wait_time)
+                if on_delivered:
+                    logger.warning(f"Flood wait {wait_time} сек: сообщение {message.id} отложено до снятия штрафа")
+                    self._park(message, target, pair, on_delivered)
+                    return False
+                if not wait_flood:
+                    return False
+                # Следующий acquire для этой цели дождётся конца штрафа
                 logger.warning(f"Flood wait: ждём {wait_time} сек (попытка {attempt + 1})")
-                await asyncio.sleep(wait_time)
 
             except Exception as e:
                 logger.error(f"Ошибка {attempt + 1}/{self.max_retries} при обработке сообщения {message.id}: {e}")
+                self._invalidate_peer(target, e)
                 if attempt < self.max_retries - 1:
                     await asyncio.sleep(self.retry_delay)
                 else:
                     return False
         return False
 
+    @staticmethod
+    def _sent_id(sent):
+        """id сообщения в цели по результату отправки (альбом - последняя часть)"""
+        if isinstance(sent, list):
+            sent = next((m for m in reversed(sent) if m is not None), None)
+        return getattr(sent, 'id', 0)
+
+    async def _map_sent(self, pair, source_ids, sent):
+        """Запись соответствия id источника и цели; части альбома и пачки сопоставляются по порядку"""
+        sent = sent if isinstance(sent, list) else [sent]
+        links = [(source_id, m.id) for source_id, m in zip(source_ids, sent) if getattr(m, 'id', None)]
+        if links:
+            self.message_map.add(await self._peer_id(pair['source']), await self._peer_id(pair['target']), links)
+
+    async def _peer(self, name):
+        """InputPeer из постоянного кеша - без ResolveUsername на горячем пути"""
+        return await self.entities.resolve(self.client, name)
+
+    async def _reply_to(self, message, pair):
+        """id копии сообщения, на которое отвечает оригинал, в цели пары; None - не ответ или оригинал не копировался.
+
+        Берётся из карты id (горячие записи - из LRU-кеша), без запроса к Telegram.
+        """
+        header = getattr(message, 'reply_to', None)
+        reply_id = getattr(header, 'reply_to_msg_id', None)
+        if not reply_id or getattr(header, 'reply_to_peer_id', None):
+            return None  # Ответ на сообщение другого чата не переносится
+        return self.message_map.target_id(await self._peer_id(pair['source']), await self._peer_id(pair['target']),
+                                          reply_id)
+
+    async def _peer_id(self, name):
+        return utils.get_peer_id(await self._peer(name))
+
+    def _invalidate_peer(self, name, error):
+        if isinstance(error, (errors.ChannelInvalidError, errors.PeerIdInvalidError)):
+            self.entities.invalidate(name)
+
+    async def _resolve_entities(self):
+        """Разрешение всех источников и целей при старте (из кеша - без запросов)"""
+        for pair in self.channel_pairs:
+            for name in (pair['source'], pair['target']):
+                try:
+                    await self._peer(name)
+                except Exception as e:
+                    logger.error(f"Не удалось разрешить {name}: {e}")
+
+    def _park(self, message, target, pair, on_delivered):
+        async def job():
+            if await self._process_message_with_retry(message, target, pair, on_delivered, resumed=True):
+                on_delivered()
+
+        self.deferred.park(target, (pair['name'], message.id), job)
+
+    def _schedule_post(self, message, pair, post_time):
+        """Постановка сообщения в отложенную очередь компактной записью (с записью в журнал)"""
+        caption, _ = self._render_caption(message, pair)
+        post = ScheduledPost(
+            source=pair['source'],
+            source_peer=utils.get_peer_id(message.peer_id) if getattr(message, 'peer_id', None) else None,
+            message_id=message.id,
+            target=pair['target'],
+            pair=pair['name'],
+            due=post_time.timestamp(),
+            caption=caption,
+            media=self._media_reference(message),
+            group=message.ids if isinstance(message, Album) else None,
+            message_hash=self._generate_message_hash(message, pair['target'])
+        )
+        self.scheduled_posts.push(post, post.target, post.due)
+        self.scheduled_until[post.pair] = max(self.scheduled_until.get(post.pair, 0), post.message_id)
+        self._journal('scheduled_posts', post.key, post.to_list())
+
+    def _finish_post(self, post):
+        self.scheduled_posts.done(post, post.target)
+        self._journal('scheduled_posts', post.key, None)
+
+    def _find_pair(self, post):
+        for pair in self.channel_pairs:
+            if pair['name'] == post.pair or (pair['source'], pair['target']) == (post.source, post.target):
+                return pair
+        return None
+
     async def _post_scheduler(self):
+        """Публикация отложенных постов: спим ровно до срока ближайшего поста"""
         while self.running:
+            post = await self.scheduled_posts.get()
             try:
-                if self.scheduled_posts.empty():
-                    await asyncio.sleep(5)
+                pair = self._find_pair(post)
+                if pair is None:
+                    logger.warning(f"Пара для отложенного поста {post.source} -> {post.target} не найдена, пропускаем")
+                    self._finish_post(post)
                     continue
 
-                now = datetime.now()
-                post = await self.scheduled_posts.get()
-
-                scheduled_time = datetime.fromisoformat(post['scheduled_time'])
-                if scheduled_time > now:
-                    await self.scheduled_posts.put(post)
-                    await asyncio.sleep(5)
+                # Восстанавливаем объект сообщения
+                if self.rate_limiter.is_blocked(post.target):
+                    # Цель под штрафом: пост возвращается в начало её очереди, остальные цели не ждут
+                    self.scheduled_posts.retry(post, post.target, self.rate_limiter.penalty_left(post.target))
                     continue
 
-                # Восстанавливаем объект сообщения
-                message = await self._recreate_message(post['message'])
+                message = await self._recreate_message(post)
                 if message:
-                    success = await self._process_message_with_retry(message, post['target'])
-                    if success:
-                        logger.info(f"Опубликовано отложенное сообщение {message.id}")
-                        self.state['last_message_ids'][post['source']] = message.id
-                        self._save_state()
-                    else:
-                        await self.scheduled_posts.put(post)
+                    success = await self._process_message_with_retry(message, post.target, pair, wait_flood=False)
+                elif post.caption or post.media:
+                    logger.warning(f"Сообщение {post.message_id} недоступно, публикуем по сохранённой записи")
+                    success = await self._send_from_record(post, pair)
+                else:
+                    logger.error(f"Не удалось восстановить сообщение {post.message_id}")
+                    self._finish_post(post)
+                    continue
+
+                if success:
+                    logger.info(f"Опубликовано отложенное сообщение {post.message_id}")
+                    self._finish_post(post)
+                    self._advance_route(pair, post.message_id)
                 else:
-                    logger.error(f"Не удалось восстановить сообщение {post['message']['id']}")
+                    # Пост остаётся первым в очереди своей цели, остальные цели публикуются дальше
+                    delay = self.rate_limiter.penalty_left(post.target) or self.retry_delay
+                    self.scheduled_posts.retry(post, post.target, delay)
 
             except Exception as e:
                 logger.error(f"Ошибка планировщика: {str(e)[:200]}...")
-                await asyncio.sleep(10)
+                self.scheduled_posts.retry(post, post.target, 10)
+
+    async def _recreate_message(self, post):
+        """Получение оригинального сообщения по записи отложенного поста (через пакетный кеш)"""
+        peer = post.source_peer or post.source
+        if post.group:
+            try:
+                parts = await self.client.get_messages(await self._peer(post.source), ids=post.group)
+            except Exception as e:
+                logger.error(f"Ошибка восстановления альбома: {e}")
+                return None
+            parts = [m for m in parts if m is not None]
+            return Album(parts) if parts else None
+
+        # Чтение без удаления: то же сообщение может ждать публикации в нескольких целях, устаревшее убирает TTL
+        cached = self.message_cache.get((peer, post.message_id))
+        if cached and time.monotonic() - cached[1] < self.message_cache_ttl:
+            return cached[0]
 
-    async def _recreate_message(self, msg_data):
-        """Восстановление сообщения из сохраненных данных"""
         try:
-            # Здесь должна быть логика восстановления объекта сообщения
-            # В зависимости от того, как вы храните данные
-            return await self.client.get_messages(
-                entity=msg_data.get('peer'),
-                ids=msg_data['id']
-            )
+            await self._prefetch_due_messages(post)
         except Exception as e:
             logger.error(f"Ошибка восстановления сообщения: {e}")
             return None
+        cached = self.message_cache.get((peer, post.message_id))
+        return cached[0] if cached else None
+
+    async def _prefetch_due_messages(self, post):
+        """Один запрос get_messages на все наступившие посты того же источника (до 100 id)"""
+        peer, message_id = post.source_peer or post.source, post.message_id
+        now = time.monotonic()
+        self.message_cache = {k: v for k, v in self.message_cache.items() if now - v[1] < self.message_cache_ttl}
+
+        ids = [message_id]
+        for due_post in self.scheduled_posts.due():
+            if len(ids) >= 100:
+                break
+            if (due_post.source_peer or due_post.source) == peer and due_post.message_id not in ids \
+                    and not due_post.group and (peer, due_post.message_id) not in self.message_cache:
+                ids.append(due_post.message_id)
+
+        messages = await self.client.get_messages(entity=await self._peer(post.source), ids=ids)
+        for msg_id, message in zip(ids, messages):
+            self.message_cache[(peer, msg_id)] = (message, now)
+        if len(ids) > 1:
+            logger.info(f"Загружено {len(ids)} отложенных сообщений из {peer} одним запросом")
+
+    async def _send_from_record(self, post, pair):
+        """Публикация по сохранённым подписи и ссылке на медиа; копия учитывается как при обычной отправке"""
+        if self.outbox.delivered(pair['name'], post.message_id):
+            logger.info(f"Сообщение {post.message_id} уже доставлено в {post.target}")
+            return True
+        if post.message_hash and post.message_hash in self.message_hashes:
+            logger.info(f"Сообщение {post.message_id} уже было скопировано ранее (дубликат)")
+            self.outbox.complete(pair['name'], post.message_id)
+            return True
+
+        try:
+            if post.media:
+                kind, media_id, access_hash, file_reference = post.media
+                input_cls = InputPhoto if kind == 'photo' else InputDocument
+                media = input_cls(media_id, access_hash, base64.b64decode(file_reference))
+                sent = await self.client.send_file(await self._peer(post.target), media, caption=post.caption,
+                                                   parse_mode='html')
+            else:
+                sent = await self.client.send_message(await self._peer(post.target), post.caption, parse_mode='html')
+        except Exception as e:
+            logger.error(f"Ошибка публикации по записи {post.key}: {e}")
+            return False
+
+        if post.message_hash:
+            self.message_hashes.add(post.message_hash)
+        self.outbox.complete(pair['name'], post.message_id, self._sent_id(sent))
+        await self._map_sent(pair, [post.message_id], sent)
+        return True
+
+    @staticmethod
+    def _media_reference(message):
+        """Ссылка на фото/документ сообщения для повторной отправки без скачивания"""
+        media = getattr(message, 'media', None)
+        if isinstance(media, MessageMediaPhoto) and media.photo:
+            kind, obj = 'photo', media.photo
+        elif isinstance(media, MessageMediaDocument) and media.document:
+            kind, obj = 'document', media.document
+        else:
+            return None
+        return [kind, obj.id, obj.access_hash, base64.b64encode(obj.file_reference).decode()]
 
 
     async def _init_last_message_ids(self):
-        for pair in self.channel_pairs:
-            source = pair['source']
-            if source not in self.state['last_message_ids']:
+        """Начальные курсоры источников; при копировании истории новые сообщения идут с текущего
+        последнего id, а более старые копирует фоновая задача (_copy_history) по своему чекпоинту"""
+        history = self.state['history']
+        for source, routes in self.routes.items():
+            cursor = self.state['last_message_ids'].get(source)
+            if cursor is not None and (self.copy_history_days == 0 or source in history):
+                continue
+
+            newest = 0
+            async for msg in self.client.iter_messages(await self._peer(source), limit=1):
+                newest = msg.id
+
+            if self.copy_history_days != 0:
+                # Запись создаётся и при пустом диапазоне - источник больше не инициализируется заново
+                since = None
                 if self.copy_history_days > 0:
-                    self.state['last_message_ids'][source] = 0
-                    logger.info(f"Инициализирован last_message_id=0 для {source} (режим копирования истории)")
-                elif self.copy_history_days == -1:
-                    self.state['last_message_ids'][source] = 0
-                    logger.info(
-                        f"Инициализирован last_message_id=0 для {source} (режим полного копирования всей истории)")
-                else:
-                    async for msg in self.client.iter_messages(source, limit=1):
-                        self.state['last_message_ids'][source] = msg.id
-                        logger.info(
-                            f"Инициализирован last_message_id={msg.id} для {source} (режим только новых сообщений)")
-                self._save_state()
+                    since = (datetime.now(timezone.utc) - timedelta(days=self.copy_history_days)).timestamp()
+                start = min(cursor or 0, newest)
+                history[source] = {'start': start, 'cursor': start, 'until': newest, 'since': since}
+                self._journal('history', source, history[source])
+                if start < newest:
+                    logger.info(f"История {source}: будут скопированы id {start + 1}..{newest}"
+                                + (f" не старше {self.copy_history_days} дн." if since else ""))
+
+            self.state['last_message_ids'].setdefault(source, newest)
+            for pair in routes:
+                self._advance_route(pair, newest)
+            self._journal('last_message_ids', source, self.state['last_message_ids'][source])
+            logger.info(f"Инициализирован last_message_id={newest} для {source}")
 
     async def start(self):
         await self.client.start()
         logger.info("Клиент успешно запущен")
+        await self._resolve_entities()
+        await self._load_dictionaries()
 
         # # Добавленная проверка прав
         # if not await self._check_bot_permissions():
@@ -326,16 +690,26 @@ class TelegramChannelCopier:
         #     await self.stop()
         #     return
 
-        asyncio.create_task(self._post_scheduler())  # <-- Добавьте эту строку
-
         await self._init_last_message_ids()
 
-        if self.copy_history_days > 0:
-            await self._copy_history()
-            logger.info("Первоначальная история скопирована")
-
         # await self._start_web_server()
         self.running = True
+        # Сначала досылается то, что не успело уйти до остановки
+        await self._resume_outbox()
+        self.scheduler_task = asyncio.create_task(self._post_scheduler())
+        await self._subscribe_mirroring()
+        if self.copy_history_days != 0:
+            self.history_task = asyncio.create_task(self._copy_history())
+        self.dictionary_task = asyncio.create_task(self._watch_dictionaries())
+
+        if self.mode == 'realtime':
+            try:
+                await self._run_realtime()
+            except asyncio.CancelledError:
+                logger.info("Получен запрос на завершение работы")
+            finally:
+                await self.stop()
+            return
 
         try:
             while self.running:
@@ -351,119 +725,596 @@ class TelegramChannelCopier:
         finally:
             await self.stop()
 
-    async def _copy_history(self):
-        if self.copy_history_days <= 0 and self.copy_history_days != -1:
-            return
+    async def _load_dictionaries(self):
+        """Загрузка словарей тегов, используемых парами, до начала копирования (в потоке).
 
-        date_threshold = None
-        if self.copy_history_days > 0:
-            date_threshold = datetime.now() - timedelta(days=self.copy_history_days)
-            logger.info(f"Копирование истории сообщений с {date_threshold}")
-        else:
-            logger.info(f"Копирование ВСЕЙ истории сообщений (с самого начала)")
+        Словарь, который не загрузился, останавливает запуск: иначе сообщения пар с тегами не отправлялись бы.
+        """
+        for name in sorted({pair['tag_dictionary'] for pair in self.channel_pairs if pair['tag']}):
+            try:
+                await get_dictionary(name).refresh()
+            except Exception as e:
+                logger.error(f"Не удалось загрузить словарь тегов {name}: {e}")
+                raise
+
+    async def _watch_dictionaries(self):
+        """Перечитывание изменённых файлов словарей без перезапуска (ошибки - в лог, остаётся прежняя версия)"""
+        while self.running and self.dictionary_check_interval > 0:
+            await asyncio.sleep(self.dictionary_check_interval)
+            for name in await refresh_dictionaries():
+                logger.info(f"Словарь тегов {name} перезагружен")
+
+    async def _run_realtime(self):
+        """Режим realtime: новые сообщения приходят обновлениями, догоняющий проход - только при разрыве"""
+        await self._subscribe_sources()
+        await self._catch_up_all("запуск")
+
+        was_connected = True
+        while self.running:
+            connected = self.client.is_connected()
+            if connected and not was_connected:
+                # Пока соединения не было, обновления могли потеряться
+                await self._catch_up_all("переподключение")
+            was_connected = connected
+            await self._retry_outbox()
+            await asyncio.sleep(self.reconnect_check_interval)
+
+    async def _resolve_source_peers(self):
+        """peer id источников для сопоставления обновлений (один раз на все подписки)"""
+        if self.sources_by_peer_id:
+            return
+        for source in self.routes:
+            try:
+                entity = await self._peer(source)
+            except Exception as e:
+                logger.error(f"Не удалось найти источник {source}: {e}")
+                continue
+            self.sources_by_peer_id.setdefault(utils.get_peer_id(entity), []).append(source)
 
-        for pair in self.channel_pairs:
-            source = pair['source']
-            last_id = self.state['last_message_ids'].get(source, 0)
+    async def _subscribe_sources(self):
+        await self._resolve_source_peers()
+        self.client.add_event_handler(
+            self._on_new_message,
+            events.NewMessage(chats=list(self.sources_by_peer_id))
+        )
+        logger.info(f"Подписка на обновления {len(self.sources_by_peer_id)} источников (режим realtime)")
 
-            async for message in self.client.iter_messages(
-                    source,
-                    offset_date=date_threshold,
-                    reverse=True
-            ):
-                if date_threshold and message.date < date_threshold:
+    async def _subscribe_mirroring(self):
+        """Подписка на правки и удаления в источниках (в любом режиме) - без повторного чтения истории"""
+        if not self.mirror_edits and not self.mirror_deletes:
+            return
+        await self._resolve_source_peers()
+        chats = list(self.sources_by_peer_id)
+        if self.mirror_edits:
+            self.client.add_event_handler(self._on_message_edited, events.MessageEdited(chats=chats))
+        if self.mirror_deletes:
+            self.client.add_event_handler(self._on_message_deleted, events.MessageDeleted(chats=chats))
+        logger.info(f"Повтор {'правок' if self.mirror_edits else ''}"
+                    f"{' и ' if self.mirror_edits and self.mirror_deletes else ''}"
+                    f"{'удалений' if self.mirror_deletes else ''} для {len(chats)} источников")
+
+    async def _on_message_edited(self, event):
+        if event.message.edit_date is None:
+            return  # Не правка текста (реакции, счётчики)
+        # Серия правок одного сообщения сливается в одну - применяется последняя версия
+        self.edit_debouncer.push((event.chat_id, event.message.id), event.message)
+
+    async def _on_message_deleted(self, event):
+        if event.chat_id is not None:
+            self.delete_debouncer.push(event.chat_id, set(event.deleted_ids))
+
+    async def _mirror_edit(self, key, message):
+        """Правка копий сообщения во всех целях источника (подпись - по правилам пары)"""
+        chat_id, message_id = key
+        for source in self.sources_by_peer_id.get(chat_id, []):
+            for pair in self.routes[source]:
+                target_id = self.message_map.target_id(chat_id, await self._peer_id(pair['target']), message_id)
+                text, _ = self._render_caption(message, pair)
+                text = text or ''  # Текст удалён в источнике - очищаем и в копии
+                if target_id is None:
+                    self._update_scheduled_caption(pair, message_id, text)
                     continue
+                edit = lambda peer: self.client.edit_message(peer, target_id, text, parse_mode='html')
+                if await self._mirror_request(pair['target'], edit):
+                    logger.info(f"Правка сообщения {message_id} повторена в {pair['target']} ({target_id})")
+
+    def _update_scheduled_caption(self, pair, message_id, caption):
+        """Правка ещё не опубликованного (delayed) поста: оригинал перечитывается при публикации,
+        а сохранённую на случай его недоступности подпись обновляем здесь"""
+        for post in self.scheduled_posts.posts():
+            if post.pair == pair['name'] and (post.message_id == message_id or message_id in (post.group or ())):
+                if post.group:
+                    # Подпись альбома - текст первой части с текстом, по правке одной части её не пересобрать;
+                    # при публикации альбом перечитывается целиком вместе с правкой
+                    logger.info(f"Правка части {message_id} отложенного альбома для {pair['target']} "
+                                f"не меняет сохранённую подпись")
+                    return
+                post.caption = caption
+                self._journal('scheduled_posts', post.key, post.to_list())
+                logger.info(f"Правка сообщения {message_id} учтена в отложенном посте для {pair['target']}")
+                return
+        logger.info(f"Правка сообщения {message_id} пропущена для {pair['target']}: копии нет "
+                     f"(не прошло фильтр, скопировано до ведения карты id или ещё не отправлено)")
+
+    async def _mirror_delete(self, chat_id, message_ids):
+        """Удаление копий во всех целях источника, по 100 id за запрос"""
+        for source in self.sources_by_peer_id.get(chat_id, []):
+            for pair in self.routes[source]:
+                target_peer = await self._peer_id(pair['target'])
+                mapped = {source_id: self.message_map.target_id(chat_id, target_peer, source_id)
+                          for source_id in sorted(message_ids)}
+                mapped = {source_id: target_id for source_id, target_id in mapped.items() if target_id}
+                target_ids = list(mapped.values())
+                for start in range(0, len(target_ids), FORWARD_BATCH_SIZE):
+                    chunk = target_ids[start:start + FORWARD_BATCH_SIZE]
+                    if not await self._mirror_request(
+                            pair['target'], lambda peer: self.client.delete_messages(peer, chunk)):
+                        break
+                else:
+                    if mapped:
+                        self.message_map.remove(chat_id, target_peer, list(mapped))
+                        logger.info(f"Удаление {len(mapped)} сообщений повторено в {pair['target']}")
 
-                if not self._should_copy(message, pair['filter_keywords']):
-                    continue
+    async def _mirror_request(self, target, request):
+        """Запрос правки/удаления в цель под общим ограничителем темпа; True - выполнен"""
+        for attempt in range(self.max_retries):
+            try:
+                peer = await self._peer(target)
+                await self.rate_limiter.acquire(target)
+                await request(peer)
+                self.rate_limiter.on_success(target)
+                return True
+            except errors.MessageNotModifiedError:
+                return True
+            except errors.FloodWaitError as e:
+                # Следующий acquire для этой цели дождётся конца штрафа
+                self.rate_limiter.on_flood_wait(target, e.seconds + 10)
+                logger.warning(f"Flood wait {e.seconds + 10} сек при правке в {target} (попытка {attempt + 1})")
+            except Exception as e:
+                logger.error(f"Ошибка правки/удаления в {target}: {e}")
+                self._invalidate_peer(target, e)
+                return False
+        logger.warning(f"Правка/удаление в {target} отброшено после {self.max_retries} flood wait подряд")
+        return False
 
-                # Замена на вызов с повтором
-                success = await self._process_message_with_retry(message, pair['target'])
-                if success:
-                    self.state['last_message_ids'][source] = message.id
-                    self._save_state()
-                await asyncio.sleep(5)  # Уменьшил задержку между сообщениями
+    async def _catch_up_all(self, reason):
+        logger.info(f"Догоняющий проход по всем источникам ({reason})")
+        await asyncio.gather(*(self._check_source_isolated(source, limit=None) for source in self.routes))
 
-                # await self._process_message(message, pair['target'])
-                # self.state['last_message_ids'][source] = message.id
-                # self._save_state()
-                # await asyncio.sleep(5)  # Задержка для избежания flood control
+    async def _on_new_message(self, event):
+        for source in self.sources_by_peer_id.get(event.chat_id, []):
+            try:
+                await self._handle_realtime_message(source, event.message)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления в {source}: {str(e)[:200]}...")
+                for pair in self.routes[source]:
+                    self._pair_stats(pair)['errors'] += 1
+
+    async def _handle_realtime_message(self, source, message):
+        async with self._source_lock(source), self.pair_semaphore:
+            seen = self.seen_message_ids.get(source, self.state['last_message_ids'].get(source, 0))
+            if message.id <= seen:
+                return  # Уже обработано догоняющим проходом
+
+            if message.id > seen + 1:
+                logger.info(f"Пропуск в {source}: ожидался id {seen + 1}, пришёл {message.id} - догоняем")
+                await self._check_source(source, limit=None)
+                return
 
-    async def _check_new_messages(self):
-        for pair in self.channel_pairs:
-            if not self.running:
-                break
+            if getattr(message, 'grouped_id', None):
+                # Альбом создаётся одним запросом, так что все части уже есть; обновления о них пропустятся по id
+                message = await complete_album(self.client, await self._peer(source), Album([message]))
+
+            self.seen_message_ids[source] = message.id
+            routes = self.routes[source]
+            batches = self._route_messages(routes, [message], {p['name']: self._route_cursor(p) for p in routes})
+            await asyncio.gather(*(self._deliver(pair, batches[pair['name']], message.id) for pair in routes))
 
-            source = pair['source']
-            last_id = self.state['last_message_ids'].get(source, 0)
-            logger.info(f"Проверка новых сообщений для {source} (last_id={last_id})")
+    def _source_lock(self, source):
+        return self.source_locks.setdefault(source, asyncio.Lock())
 
+    async def _copy_history(self):
+        """Копирование истории всех источников по чекпоинтам, параллельно с новыми сообщениями"""
+        pending = [source for source, job in self.state['history'].items()
+                   if source in self.routes and job['cursor'] < job['until']]
+        if not pending:
+            return
+        logger.info(f"Копирование истории {len(pending)} источников")
+        # Одна takeout-сессия на все источники (если включена)
+        async with open_history_reader(self.client, self.history_takeout) as reader:
+            await asyncio.gather(*(self._backfill_source_isolated(source, reader) for source in pending))
+        logger.info("Первоначальная история скопирована")
+
+    async def _backfill_source_isolated(self, source, reader):
+        async with self.history_semaphore:
             try:
-                messages = []
-                async for message in self.client.iter_messages(
-                        source,
-                        limit=self.batch_size,
-                        min_id=last_id,
-                        reverse=True
-                ):
+                await self._backfill_source(source, reader)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Чекпоинт сохранён - при следующем запуске копирование продолжится с него
+                logger.error(f"Ошибка копирования истории {source}: {str(e)[:200]}...")
+                self._invalidate_peer(source, e)
+
+    async def _backfill_source(self, source, reader):
+        """История одного источника: чтение страницами наперёд, отправка во все цели, чекпоинт после каждого сообщения"""
+        job = self.state['history'][source]
+        routes = self.routes[source]
+        progress = BackfillProgress(job)
+        queue = asyncio.Queue(maxsize=self.history_prefetch)
+        fetcher = asyncio.create_task(self._fetch_history(source, job, queue, reader))
+        logger.info(f"История {source}: продолжение с id {job['cursor']} до {job['until']}")
+        try:
+            while self.running:
+                message = await queue.get()
+                if message is None:
+                    break
+                if isinstance(message, Exception):
+                    raise message  # Ошибка чтения - в _backfill_source_isolated, чекпоинт остаётся
+
+                batches = self._route_messages(routes, [message], {pair['name']: job['cursor'] for pair in routes})
+                # Курсоры новых сообщений впереди, так что _deliver их не двигает; темп задаёт ограничитель
+                await asyncio.gather(*(self._deliver(pair, batches[pair['name']], message.id, park=False,
+                                                     priority=PRIORITY_HISTORY)
+                                       for pair in routes))
+                progress.advance(message.id)
+                self._journal('history', source, job)
+
+                if progress.report_due():
+                    logger.info(f"История {source}: {progress.summary()}")
+            else:
+                return
+
+            job['cursor'] = job['until']
+            self._journal('history', source, job)
+            logger.info(f"История {source} скопирована: {progress.summary()}")
+        finally:
+            fetcher.cancel()
+
+    async def _fetch_history(self, source, job, queue, reader):
+        """Чтение истории в очередь (до history_prefetch сообщений наперёд); FloodWait - пауза и продолжение.
+
+        Конец истории отмечается None, любая другая ошибка передаётся через очередь - её поднимет потребитель.
+        """
+        try:
+            peer = await self._peer(source)
+            since = datetime.fromtimestamp(job['since'], timezone.utc) if job.get('since') else None
+            fetched = job['cursor']
+            while True:
+                try:
+                    async for message in group_albums(reader.iter_messages(
+                            peer, min_id=fetched, max_id=job['until'] + 1, offset_date=since)):
+                        if since and message.date < since:
+                            continue
+                        await queue.put(message)
+                        fetched = message.id
+                    break
+                except errors.FloodWaitError as e:
+                    self.rate_limiter.block(source, 'GetHistoryRequest', e.seconds)
+                    await asyncio.sleep(e.seconds)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(None)
+
+    async def _check_new_messages(self):
+        """Параллельная проверка всех источников: каждый - отдельная задача под общим семафором"""
+        started = time.monotonic()
+        await self._retry_outbox()
+        await asyncio.gather(*(self._check_source_isolated(source) for source in self.routes))
+        logger.info(f"Цикл проверки {len(self.routes)} источников ({len(self.channel_pairs)} пар) "
+                    f"занял {time.monotonic() - started:.1f} сек")
+        self._log_pair_stats()
+
+    async def _check_source_isolated(self, source, limit=0):
+        """Проверка одного источника; ошибки и задержки источника не влияют на остальные"""
+        async with self._source_lock(source), self.pair_semaphore:
+            if not self.running:
+                return
+            started = time.monotonic()
+            try:
+                await self._check_source(source, limit)
+            except Exception as e:
+                logger.error(f"Ошибка в канале {source}: {str(e)[:200]}...")
+                self._invalidate_peer(source, e)
+                for pair in self.routes[source]:
+                    self._pair_stats(pair)['errors'] += 1
+                await asyncio.sleep(10)
+            finally:
+                for pair in self.routes[source]:
+                    stats = self._pair_stats(pair)
+                    stats['last_check'] = datetime.now()
+                    stats['check_duration'] = time.monotonic() - started
+
+    async def _check_source(self, source, limit=0):
+        """Одна выборка новых сообщений источника на все его пары; limit=0 - batch_size, None - всё с last_id"""
+        if self.rate_limiter.is_blocked(source, 'GetHistoryRequest'):
+            logger.debug(f"Чтение {source} под штрафом FloodWait, пропускаем цикл")
+            return
+        routes = self.routes[source]
+        # Уже запланированные (delayed), но ещё не опубликованные сообщения повторно не выбираем
+        floors = {pair['name']: max(self._route_cursor(pair), self.scheduled_until.get(pair['name'], 0))
+                  for pair in routes}
+        last_id = min(floors.values())
+        logger.info(f"Проверка новых сообщений для {source} (last_id={last_id}, целей: {len(routes)})")
+
+        messages = []
+        peer = await self._peer(source)
+        fetch_limit = self.batch_size if limit == 0 else limit
+        try:
+            # Части альбомов собираются прямо при выборке
+            async for message in group_albums(self.client.iter_messages(
+                    peer,
+                    limit=fetch_limit,
+                    min_id=last_id,
+                    reverse=True
+            )):
+                if not self.running:
+                    break
+                messages.append(message)
+            if fetch_limit and messages and isinstance(messages[-1], Album):
+                # limit мог оборвать последний альбом
+                await complete_album(self.client, peer, messages[-1])
+        except errors.FloodWaitError as e:
+            # Штраф на чтение касается только этого источника; уже прочитанное обрабатываем
+            self.rate_limiter.block(source, 'GetHistoryRequest', e.seconds)
+            if messages and isinstance(messages[-1], Album):
+                messages.pop()  # Возможно неполный альбом - дочитаем в следующий раз
+
+        if not messages:
+            return
+
+        last_id = messages[-1].id
+        self.seen_message_ids[source] = max(self.seen_message_ids.get(source, 0), last_id)
+        batches = self._route_messages(routes, messages, floors)
+
+        if self.mode != 'delayed':
+            # Стандартный (и realtime) режим - цели получают сообщения параллельно, каждая по порядку
+            await asyncio.gather(*(self._deliver(pair, batches[pair['name']], last_id) for pair in routes))
+
+        else:  # Режим delayed
+            current_time = datetime.now()
+            for pair in routes:
+                batch = batches[pair['name']]
+                if not batch and self.scheduled_until.get(pair['name'], 0) <= self._route_cursor(pair):
+                    # Всё отсеяно фильтром и ничего не ждёт публикации - сдвигаем курсор пары
+                    self._advance_route(pair, last_id)
+                for i, message in enumerate(batch):
                     if not self.running:
                         break
 
-                    if self._should_copy(message, pair['filter_keywords']):
-                        messages.append(message)
-
-                if not messages:
-                    continue
+                    # Распределяем сообщения с учетом интервала (в минутах)
+                    post_time = current_time + timedelta(minutes=i * (self.post_interval / len(batch)))
+
+                    self._schedule_post(message, pair, post_time)
+                    logger.info(f"Сообщение {message.id} запланировано на {post_time} в {pair['target']}")
+
+    def _route_messages(self, routes, messages, floors):
+        """Раскладка выборки по парам; пары с общим фильтром проверяют сообщение один раз"""
+        batches = {pair['name']: [] for pair in routes}
+        for message in messages:
+            verdicts = {}
+            for pair in routes:
+                if message.id <= floors[pair['name']]:
+                    continue  # Эта цель уже получила сообщение
+                key = id(pair['filter'])
+                if key not in verdicts:
+                    verdicts[key] = self._should_copy(message, pair)
+                if verdicts[key]:
+                    batches[pair['name']].append(message)
+        return batches
+
+    async def _deliver(self, pair, messages, last_id=None, park=True, priority=PRIORITY_LIVE):
+        """Отправка сообщений пары по порядку через outbox.
+
+        Сообщения сначала записываются в outbox, и только потом курсор пары сдвигается на last_id:
+        неотправленное не теряется за следующим успешным, а досылается из outbox (_resume_outbox).
+        Уже доставленные по outbox сообщения повторно не отправляются.
+        park=False - при FloodWait ждать снятия штрафа на месте, а не откладывать в очередь цели.
+        """
+        messages = [message for message in messages if not self.outbox.delivered(pair['name'], message.id)]
+        self.outbox.add(pair['name'], messages)
+        if last_id is not None:
+            self._advance_route(pair, last_id)
+
+        items = self._forward_batches(messages, pair) if pair['copy_strategy'] == 'batch_forward' else messages
+        for item in items:
+            if not self.running:
+                return
+            if isinstance(item, list):
+                delivered = await self._forward_batch(item, pair, park, priority=priority)
+            else:
+                delivered = await self._copy_one(item, pair, park, priority)
+            if not delivered and pair['target'] not in self.deferred:
+                # Не отложено в очередь цели - запись подхватит следующая досылка
+                batch = item if isinstance(item, list) else [item]
+                self.outbox.release(pair['name'], [message.id for message in batch])
+
+    async def _resume_outbox(self, older_than=0):
+        """Досылка незавершённых записей outbox (после перезапуска - всех, далее - зависших дольше older_than сек)"""
+        self.outbox_checked = time.monotonic()
+        pending = self.outbox.pending(older_than)
+        pairs = {pair['name']: pair for pair in self.channel_pairs}
+        for name in set(pending) - set(pairs):
+            logger.warning(f"Пара {name} удалена из конфигурации, её незавершённые записи outbox пропущены")
+        await asyncio.gather(*(self._resume_pair(pairs[name], entries)
+                               for name, entries in pending.items() if name in pairs))
+
+    async def _retry_outbox(self):
+        if time.monotonic() - self.outbox_checked >= self.outbox_retry_after:
+            await self._resume_outbox(self.outbox_retry_after)
+
+    async def _resume_pair(self, pair, entries):
+        """Повторная выборка сообщений незавершённых записей пары (по 100 id за запрос) и отправка по порядку"""
+        async with self._source_lock(pair['source']), self.pair_semaphore:
+            try:
+                peer = await self._peer(pair['source'])
+                ids = [i for source_id, first_id in entries for i in range(first_id, source_id + 1)]
+                fetched = {}
+                for start in range(0, len(ids), FORWARD_BATCH_SIZE):
+                    for message in await self.client.get_messages(peer, ids=ids[start:start + FORWARD_BATCH_SIZE]):
+                        if message is not None:
+                            fetched[message.id] = message
 
-                if self.mode == 'standard':
-                    # Стандартный режим - отправка с базовой задержкой
-                    for message in messages:
-                        if not self.running:
-                            break
+                messages = []
+                for source_id, first_id in entries:
+                    parts = [fetched[i] for i in range(first_id, source_id + 1) if i in fetched]
+                    if not parts or parts[-1].id != source_id:
+                        # Сообщение (или последняя часть альбома) удалено в источнике - запись закрывается,
+                        # оставшиеся части альбома получают свою
+                        self.outbox.complete(pair['name'], source_id)
+                    if parts:
+                        messages.append(Album(parts) if source_id != first_id else parts[0])
+                logger.info(f"Пара {pair['name']}: досылка {len(messages)} незавершённых сообщений")
+                await self._deliver(pair, messages)
+            except Exception as e:
+                logger.error(f"Ошибка досылки outbox пары {pair['name']}: {str(e)[:200]}...")
+                self._invalidate_peer(pair['source'], e)
+
+    async def _copy_one(self, message, pair, park=True, priority=PRIORITY_LIVE):
+        on_delivered = (lambda: self._on_delivered(pair, message)) if park else None
+        if await self._process_message_with_retry(message, pair['target'], pair, on_delivered=on_delivered,
+                                                  priority=priority):
+            self._on_delivered(pair, message)
+            return True
+        return False
 
-                        success = await self._process_message_with_retry(message, pair['target'], pair)
-                        if success:
-                            self.state['last_message_ids'][source] = message.id
-                            self._save_state()
+    def _forward_batches(self, messages, pair):
+        """Пачки для пересылки (до 100 id, альбомы не разрезаются) вперемешку с сообщениями,
+        которые нужно копировать по одному: с переписанной подписью (хештеги), системными и пустыми"""
+        batch, size = [], 0
+        for message in messages:
+            if not self._forwardable(message, pair):
+                if batch:
+                    yield batch
+                    batch, size = [], 0
+                yield message
+                continue
+            count = len(message.ids) if isinstance(message, Album) else 1
+            if size + count > FORWARD_BATCH_SIZE:
+                yield batch
+                batch, size = [], 0
+            batch.append(message)
+            size += count
+        if batch:
+            yield batch
+
+    def _forwardable(self, message, pair) -> bool:
+        if isinstance(message, MessageService) or (not message.text and not message.media):
+            return False
+        if getattr(message, 'reply_to', None):
+            return False  # Пересылка теряет ответ - копия уйдёт с reply_to на копию оригинала
+        if pair.get('tag') and message.text:
+            return not find_tags(message.text, pair.get('tag_dictionary', 'car_brands'))
+        return True
 
-                        await asyncio.sleep(1)  # Базовая задержка 1 сек между сообщениями
+    async def _forward_batch(self, batch, pair, park=True, resumed=False, priority=PRIORITY_LIVE):
+        """Пересылка пачки одним запросом без подписи автора; True - доставлено сейчас"""
+        target = pair['target']
+        if park and not resumed and (target in self.deferred or self.rate_limiter.is_blocked(target)):
+            self._park_batch(batch, pair)
+            return False
 
-                else:  # Режим delayed
-                    current_time = datetime.now()
-                    for i, message in enumerate(messages):
-                        if not self.running:
-                            break
+        hashes = [self._generate_message_hash(message, target) for message in batch]
+        fresh = [(message, h) for message, h in zip(batch, hashes)
+                 if h not in self.message_hashes and not self.outbox.delivered(pair['name'], message.id)]
+        ids = [i for message, _ in fresh for i in (message.ids if isinstance(message, Album) else [message.id])]
+        for attempt in range(self.max_retries):
+            try:
+                sent_ids = {}
+                if ids:
+                    peer = await self._peer(target)
+                    await self.rate_limiter.acquire(target)
+                    sent = await self.client.forward_messages(peer, ids, await self._peer(pair['source']),
+                                                              drop_author=True)
+                    sent_ids = {i: self._sent_id(m) for i, m in zip(ids, sent)}
+                    await self._map_sent(pair, ids, sent)
+                    for _, message_hash in fresh:
+                        self.message_hashes.add(message_hash)
+                    self.rate_limiter.on_success(target)
+                    logger.info(f"Переслано {len(ids)} сообщений из {pair['source']} в {target} одним запросом")
+                forwarded = {message.id for message, _ in fresh}
+                for message in batch:
+                    # Альбом сопоставляется по последней дошедшей части; уже доставленные закрываются без id
+                    parts = message.ids if isinstance(message, Album) else [message.id]
+                    target_id = next((sent_ids[i] for i in reversed(parts) if sent_ids.get(i)), 0)
+                    self.outbox.complete(pair['name'], message.id, target_id)
+                    if message.id in forwarded and not target_id:
+                        # forward_messages вернул None - сообщение удалено в источнике после выборки
+                        logger.warning(f"Сообщение {message.id} удалено в {pair['source']} до пересылки, пропущено")
+                        continue
+                    self._on_delivered(pair, message)
+                return True
 
-                        # Распределяем сообщения с учетом интервала (в минутах)
-                        post_time = current_time + timedelta(minutes=i * (self.post_interval / len(messages)))
+            except errors.FloodWaitError as e:
+                wait_time = e.seconds + 10
+                self.rate_limiter.on_flood_wait(target, wait_time)
+                if park:
+                    logger.warning(f"Flood wait {wait_time} сек: пачка из {len(ids)} сообщений отложена")
+                    self._park_batch(batch, pair)
+                    return False
+                logger.warning(f"Flood wait: ждём {wait_time} сек (попытка {attempt + 1})")
 
-                        await self.scheduled_posts.put({
-                            'message': message,
-                            'target': pair['target'],
-                            'source': source,
-                            'scheduled_time': post_time.isoformat()
-                        })
-                        logger.info(f"Сообщение {message.id} запланировано на {post_time}")
+            except errors.ChatForwardsRestrictedError:
+                logger.warning(f"{pair['source']} запрещает пересылку, копируем сообщения по одному")
+                break
 
             except Exception as e:
-                logger.error(f"Ошибка в канале {source}: {str(e)[:200]}...")
-                await asyncio.sleep(10)
+                logger.error(f"Ошибка {attempt + 1}/{self.max_retries} пересылки пачки в {target}: {e}")
+                self._invalidate_peer(target, e)
+                self._invalidate_peer(pair['source'], e)
+                if attempt < self.max_retries - 1:
+                    await asyncio.sleep(self.retry_delay)
 
-    def _should_copy(self, message, keywords: List[str]) -> bool:
-        if not keywords:
+        # Пересылка не удалась - копируем по одному
+        delivered = True
+        for message in batch:
+            delivered = await self._copy_one(message, pair, park, priority) and delivered
+        return delivered
+
+    def _park_batch(self, batch, pair):
+        async def job():
+            await self._forward_batch(batch, pair, resumed=True)
+
+        self.deferred.park(pair['target'], (pair['name'], batch[0].id), job)
+
+    def _pair_stats(self, pair):
+        return self.pair_stats.setdefault(pair['name'], {
+            'copied': 0,
+            'errors': 0,
+            'lag': None,  # Секунды между публикацией в источнике и копированием
+            'last_check': None,
+            'check_duration': None,
+        })
+
+    def _on_delivered(self, pair, message):
+        # Курсор пары уже сдвинут при записи в outbox
+        self._record_delivery(pair, message)
+
+    def _record_delivery(self, pair, message):
+        stats = self._pair_stats(pair)
+        stats['copied'] += 1
+        if getattr(message, 'date', None):
+            stats['lag'] = (datetime.now(timezone.utc) - message.date).total_seconds()
+
+    def _log_pair_stats(self):
+        for target, per_minute, limit, flood_waits in self.rate_limiter.report():
+            logger.info(f"Цель {target}: {per_minute:.1f} сообщ./мин (предел {limit:.1f}, FloodWait: {flood_waits})")
+        for name, stats in self.pair_stats.items():
+            lag = f"{stats['lag']:.0f} сек" if stats['lag'] is not None else "-"
+            duration = f"{stats['check_duration']:.1f} сек" if stats['check_duration'] is not None else "-"
+            logger.debug(f"Пара {name}: скопировано {stats['copied']}, ошибок {stats['errors']}, "
+                         f"задержка {lag}, проверка {duration}")
+
+    def _should_copy(self, message, pair) -> bool:
+        message_filter = pair['filter']
+        if message_filter.empty:
             return True
 
-        if not getattr(message, 'text', None):
-            logger.debug(f"Сообщение {message.id} без текста - пропускаем фильтрацию")
+        if message_filter.matches(getattr(message, 'text', None)):
             return True
 
-        text = message.text.lower()
-        keywords_lower = [k.lower() for k in keywords]
-
-        if any(k in text for k in keywords_lower):
-            return True
-
-        logger.debug(f"Сообщение {message.id} не прошло фильтр по ключевым словам")
+        logger.debug(f"Сообщение {message.id} не прошло фильтр пары {pair['name']}")
         return False
 
 
@@ -491,42 +1342,14 @@ class TelegramChannelCopier:
 
 
 
-    async def _handle_album(self, message, target):
-        """Обработка медиа-альбомов как оригинальных сообщений"""
-        album_id = message.grouped_id
-        if album_id not in self.media_albums:
-            self.media_albums[album_id] = {
-                'messages': [],
-                'target': target,
-                'last_update': datetime.now()
-            }
-
-        self.media_albums[album_id]['messages'].append(message)
-        self.media_albums[album_id]['last_update'] = datetime.now()
-
-        # Ждем 2 секунды на случай, если придут другие части альбома
-        await asyncio.sleep(2)
-
-        # Если с момента последнего обновления прошло больше 2 секунд - обрабатываем
-        if (datetime.now() - self.media_albums[album_id]['last_update']).total_seconds() > 2:
-            await self._send_album(album_id)
-            del self.media_albums[album_id]
-
-    async def _send_album(self, album_id):
-        """Создание нового альбома в целевом канале"""
-        album = self.media_albums.get(album_id)
-        if not album or len(album['messages']) == 0:
-            return
-
-        messages = sorted(album['messages'], key=lambda m: m.id)
-        target = album['target']
-
+    async def _send_album(self, album, target, pair):
+        """Создание нового альбома в целевом канале одним send_file"""
         try:
             # Собираем медиафайлы и подписи для создания нового альбома
             media_input = []
             captions = []
 
-            for msg in messages:
+            for msg in album.messages:
                 # Для каждого медиа определяем правильный тип вложения
                 media = getattr(msg, 'media', None)
 
@@ -547,29 +1370,37 @@ class TelegramChannelCopier:
                     # Другие типы медиа
                     media_input.append(media)
 
-                # Сохраняем текст сообщения
-                captions.append(msg.text if msg.text else None)
+                # Подпись части с хештегами пары
+                caption, _ = self._render_caption(msg, pair)
+                captions.append(caption)
 
-            # Создаем новый альбом в целевом канале
-            await self.client.send_file(
+            # Создаем новый альбом в целевом канале (ответом, если оригинал отвечал на скопированное)
+            sent = await self.client.send_file(
                 target,
                 media_input,
-                captions=captions,
-                parse_mode='html'
+                caption=captions,
+                parse_mode='html',
+                reply_to=await self._reply_to(album, pair)
             )
-            logger.info(f"Создан новый альбом из {len(messages)} сообщений в {target}")
+            logger.info(f"Создан новый альбом из {len(album.messages)} сообщений в {target}")
+            return sent
+        except (errors.FloodWaitError, errors.ChannelInvalidError, errors.PeerIdInvalidError):
+            # Штраф и невалидную цель обрабатывает _process_message_with_retry
+            raise
         except Exception as e:
             logger.error(f"Ошибка создания альбома: {e}")
             # При ошибке пробуем переслать оригинальный альбом
             try:
-                await self.client.forward_messages(
+                sent = await self.client.forward_messages(
                     target,
-                    [msg.id for msg in messages],
-                    messages[0].peer
+                    album.ids,
+                    album.peer_id
                 )
                 logger.info(f"Переслан альбом как fallback в {target}")
+                return sent
             except Exception as e2:
                 logger.error(f"Ошибка пересылки альбома: {e2}")
+            return False
 
     async def _copy_single_message2(self, message, target, pair):
         """Копирование одиночного сообщения с поддержкой тегов брендов"""
@@ -812,8 +1643,24 @@ class TelegramChannelCopier:
             except Exception as e2:
                 logger.error(f"Ошибка пересылки {message.id}: {e2}")
 
-    async def _copy_single_message(self, message, target, pair):
-        """Копирование одиночного сообщения с поддержкой тегов брендов и логированием + фильтрация пустых"""
+    def _render_caption(self, message, pair):
+        """Подпись в html с хештегами из словаря пары (если у пары включён tag); возвращает (текст, хештеги)"""
+        text = html.escape(message.text) if message.text else None
+        hashtags = ""
+
+        # Добавление тегов по словарю пары (tag_dictionary), если включено
+        if text and pair.get('tag'):
+            found_brands = find_tags(message.text, pair.get('tag_dictionary', 'car_brands'))
+            if found_brands:
+                hashtags = ' '.join(f"#{b.replace(' ', '_')}" for b in found_brands[:3])
+                text += f"\n\n🔍 {hashtags}"
+        return text, hashtags
+
+    async def _copy_single_message(self, message, target, pair, priority=PRIORITY_LIVE):
+        """Копирование одиночного сообщения с поддержкой тегов брендов и логированием + фильтрация пустых
+
+        priority - очередь сжатия больших видео (история уступает новым сообщениям)
+        """
         try:
             # Фильтрация пустых сообщений
             if not getattr(message, "text", None) and not getattr(message, "media", None):
@@ -826,75 +1673,126 @@ class TelegramChannelCopier:
                 logger.warning(f"Сообщение {message.id} является системным, пропускаем")
                 return False
 
-            text = html.escape(message.text) if message.text else None
-            found_brands = []
-            hashtags = ""
-
-            # Добавление тегов по брендам, если включено
-            if text and pair.get('tag'):
-                found_brands = find_car_brands(message.text)
-                if found_brands:
-                    hashtags = ' '.join(f"#{b.replace(' ', '_')}" for b in found_brands[:3])
-                    text += f"\n\n🔍 {hashtags}"
+            text, hashtags = self._render_caption(message, pair)
+            reply_to = await self._reply_to(message, pair)
 
             media = getattr(message, 'media', None)
 
             # Обработка голосового сообщения
             if self._is_voice_message(media):
-                await self.client.send_file(target, media, voice_note=True, caption=text, parse_mode='html')
+                sent = await self.client.send_file(target, media, voice_note=True, caption=text, parse_mode='html',
+                                                   reply_to=reply_to)
                 logger.info(f"Скопировано сообщение {message.id} в {target}")
-                if found_brands:
+                if hashtags:
                     logger.info(f"Добавлены теги для сообщения {message.id}: {hashtags}")
-                return True
+                return sent
 
             # Обработка видеосообщения (кружок)
             if self._is_video_note(media):
-                await self.client.send_file(target, media, video_note=True, caption=text, parse_mode='html')
+                sent = await self.client.send_file(target, media, video_note=True, caption=text, parse_mode='html',
+                                                   reply_to=reply_to)
                 logger.info(f"Скопировано сообщение {message.id} в {target}")
-                if found_brands:
+                if hashtags:
                     logger.info(f"Добавлены теги для сообщения {message.id}: {hashtags}")
-                return True
+                return sent
 
             # Обработка медиа
             if media:
                 if isinstance(media, MessageMediaPhoto):
-                    await self.client.send_file(target, media, caption=text, parse_mode='html')
+                    sent = await self._send_media(target, message, caption=text, parse_mode='html', reply_to=reply_to)
                 elif isinstance(media, MessageMediaDocument):
                     if self._is_voice_message(media):
-                        await self.client.send_file(target, media, voice_note=True, caption=text, parse_mode='html')
+                        sent = await self.client.send_file(target, media, voice_note=True, caption=text,
+                                                           parse_mode='html', reply_to=reply_to)
                     elif self._is_sticker(media):
-                        await self.client.send_file(target, media.document, parse_mode='html')
+                        sent = await self.client.send_file(target, media.document, parse_mode='html', reply_to=reply_to)
+                    elif self._needs_compression(media):
+                        sent = await self._compress_and_send_video(message, target, priority, caption=text,
+                                                                   parse_mode='html', reply_to=reply_to)
                     else:
-                        await self.client.send_file(target, media, caption=text, parse_mode='html',
-                                                    attributes=media.document.attributes)
+                        sent = await self._send_media(target, message, caption=text, parse_mode='html',
+                                                      attributes=media.document.attributes, reply_to=reply_to)
                 elif isinstance(media, MessageMediaPoll):
-                    await self.client.send_poll(target, question=media.poll.question,
-                                                options=[o.text for o in media.poll.answers],
-                                                caption=text, parse_mode='html')
+                    sent = await self.client.send_poll(target, question=media.poll.question,
+                                                       options=[o.text for o in media.poll.answers],
+                                                       caption=text, parse_mode='html', reply_to=reply_to)
                 elif isinstance(media, MessageMediaGeo):
-                    await self.client.send_file(target, media, caption=text, parse_mode='html')
+                    sent = await self.client.send_file(target, media, caption=text, parse_mode='html',
+                                                       reply_to=reply_to)
                 elif isinstance(media, MessageMediaWebPage):
-                    await self.client.send_message(target, text, parse_mode='html', link_preview=True)
+                    sent = await self.client.send_message(target, text, parse_mode='html', link_preview=True,
+                                                         reply_to=reply_to)
                 else:
-                    await self.client.send_message(target, text or "", parse_mode='html')
+                    sent = await self.client.send_message(target, text or "", parse_mode='html', reply_to=reply_to)
             else:
                 # Текстовое сообщение
-                await self.client.send_message(target, text, parse_mode='html')
+                sent = await self.client.send_message(target, text, parse_mode='html', reply_to=reply_to)
 
             logger.info(f"Скопировано сообщение {message.id} в {target}")
-            if found_brands:
+            if hashtags:
                 logger.info(f"Добавлены теги для сообщения {message.id}: {hashtags}")
-            return True
+            return sent
 
+        except (errors.FloodWaitError, errors.ChannelInvalidError, errors.PeerIdInvalidError):
+            # Штраф и невалидную цель обрабатывает _process_message_with_retry, пересылка упрётся в то же
+            raise
         except Exception as e:
             logger.error(f"Ошибка копирования сообщения {message.id}: {e}")
             try:
-                await self.client.forward_messages(target, message)
+                sent = await self.client.forward_messages(target, message)
                 logger.info(f"Переслано сообщение {message.id} в {target} как fallback")
+                return sent
             except Exception as e2:
                 logger.error(f"Ошибка пересылки {message.id}: {e2}")
             return False
 
+    async def _send_media(self, target, message, **kwargs):
+        """Отправка медиа по ссылке на оригинал; если источник запрещает пересылку - через кеш загрузок"""
+        try:
+            return await self.client.send_file(target, message.media, **kwargs)
+        except errors.ChatForwardsRestrictedError:
+            logger.info(f"Медиа сообщения {message.id} защищено от пересылки, отправляем загрузкой")
+            document = getattr(message.media, 'document', None)
+            if document is not None and document.size > SMALL_FILE_LIMIT:
+                # Большой файл переливается из скачивания в загрузку потоком, без копии в памяти
+                name = message.file.name or f"media{message.file.ext or ''}"
+                produce = lambda: upload_stream(self.client, self.client.iter_download(message.media), name)
+            else:
+                produce = lambda: self.client.download_media(message, file=bytes)
+            return await self._send_uploaded(target, [MediaCache.source_key(message.media)], produce, **kwargs)
+
+    async def _send_uploaded(self, target, keys, produce, **kwargs):
+        """Отправка файла, который приходится загружать: одна загрузка на все цели и повторы.
+
+        keys - ключи исходного медиа в кеше; produce() готовит байты или уже загруженный файл и вызывается
+        только если ни по ключам, ни по sha256 содержимого загруженного файла нет.
+        """
+        async with self.media_cache.lock(keys[0]):
+            sent = await self._send_cached(target, keys, **kwargs)
+            if sent is not None:
+                return sent
+
+            data = await produce()
+            if isinstance(data, bytes):
+                keys = keys + [MediaCache.content_key(data)]
+                sent = await self._send_cached(target, keys[-1:], **kwargs)
+            if sent is None:
+                sent = await self.client.send_file(target, data, **kwargs)
+            # Для документа без байт в памяти размер возьмётся из отправленного сообщения
+            self.media_cache.put(keys, sent.media, len(data) if isinstance(data, bytes) else 0)
+            return sent
+
+    async def _send_cached(self, target, keys, **kwargs):
+        for key in keys:
+            media = self.media_cache.get(key)
+            if media is None:
+                continue
+            try:
+                return await self.client.send_file(target, media, **kwargs)
+            except (errors.FileReferenceExpiredError, errors.MediaEmptyError):
+                self.media_cache.invalidate(key)
+        return None
+
     async def _handle_large_video(self, message, target):
         """Обработка больших видеофайлов (>20MB)"""
         try:
@@ -906,22 +1804,16 @@ class TelegramChannelCopier:
 
             # Вариант 2: Можно добавить сжатие видео, но это требует дополнительных библиотек
             # и обработки файла перед отправкой
-            await self._compress_and_send_video(message, target)
+            await self._compress_and_send_video(message, target, caption=message.text, parse_mode='html')
         except Exception as e:
             logger.error(f"Ошибка обработки большого видеофайла {message.id}: {e}")
 
-    async def _handle_large_album(self, album_id):
+    async def _handle_large_album(self, album, target):
         """Обработка альбома с большими видео (>20MB)"""
-        album = self.media_albums.get(album_id)
-        if not album or len(album['messages']) == 0:
-            return
-
-        target = album['target']
-        messages = sorted(album['messages'], key=lambda m: m.id)
-
+        album_id = album.grouped_id
         try:
             # Отправляем каждое сообщение отдельно (если видео - с обработкой)
-            for msg in messages:
+            for msg in album.messages:
                 if isinstance(msg.media, MessageMediaDocument) and self._is_video_message(msg.media):
                     if msg.media.document.size > 20 * 1024 * 1024:
                         await self._handle_large_video(msg, target)  # Используем существующий метод
@@ -934,39 +1826,37 @@ class TelegramChannelCopier:
         except Exception as e:
             logger.error(f"Ошибка обработки большого альбома {album_id}: {e}")
 
-    async def _compress_and_send_video(self, message, target):
-        """Сжатие и отправка видео (требует ffmpeg)"""
+    def _needs_compression(self, media) -> bool:
+        return bool(self.compress_video_bytes) and self._is_video_message(media) \
+            and not self._is_video_note(media) and media.document.size > self.compress_video_bytes
+
+    async def _compress_and_send_video(self, message, target, priority=PRIORITY_LIVE, **kwargs):
+        """Сжатие и отправка видео (требует ffmpeg) потоком, без временных файлов.
+
+        Сжатие идёт в пуле перекодирования; результат кешируется по id документа
+        и параметрам ffmpeg, так что одно видео не сжимается и не загружается дважды.
+        """
+        # Примерные параметры сжатия
+        ffmpeg_args = ['-vcodec', 'libx264', '-crf', '28', '-preset', 'fast', '-acodec', 'copy']
+        key = transcode_key(MediaCache.source_key(message.media), ffmpeg_args)
         try:
-            # Скачиваем видео
-            video_path = await self.client.download_media(message, file='temp_video.mp4')
-
-            # Сжимаем видео с помощью ffmpeg (примерные параметры)
-            compressed_path = 'temp_video_compressed.mp4'
-            import subprocess
-            subprocess.run([
-                'ffmpeg', '-i', video_path,
-                '-vcodec', 'libx264', '-crf', '28',
-                '-preset', 'fast', '-acodec', 'copy',
-                compressed_path
-            ], check=True)
-
-            # Отправляем сжатое видео
-            await self.client.send_file(
+            # Скачивание, сжатие и загрузка идут одновременно
+            sent = await self._send_uploaded(
                 target,
-                compressed_path,
-                caption=message.text,
-                parse_mode='html'
+                [key],
+                lambda: self.transcoder.submit(
+                    key, lambda: transcode_upload(self.client, message.media, ffmpeg_args), priority),
+                supports_streaming=True,
+                **kwargs
             )
-
-            # Удаляем временные файлы
-            os.unlink(video_path)
-            os.unlink(compressed_path)
-
             logger.info(f"Видео {message.id} сжато и отправлено")
+            return sent
+        except (asyncio.CancelledError, errors.FloodWaitError, errors.ChannelInvalidError, errors.PeerIdInvalidError):
+            raise
         except Exception as e:
             logger.error(f"Ошибка сжатия видео {message.id}: {e}")
-            # Если сжатие не удалось, просто пересылаем оригинал
-            await self.client.forward_messages(target, message)
+            # Если сжатие не удалось, отправляем оригинал
+            return await self._send_media(target, message, **kwargs)
 
     def _is_video_message(self, media) -> bool:
         """Проверяет, является ли медиа видео (включая видеосообщения)"""
@@ -990,7 +1880,8 @@ class TelegramChannelCopier:
         if not isinstance(media, MessageMediaDocument):
             return False
         for attr in media.document.attributes:
-            if hasattr(attr, 'round_message'):
+            # round_message есть у любого DocumentAttributeVideo - кружок только при True
+            if getattr(attr, 'round_message', False):
                 return True
         return False
 
@@ -1056,11 +1947,27 @@ class TelegramChannelCopier:
 
     async def stop(self):
         self.running = False
+        if self.scheduler_task:
+            self.scheduler_task.cancel()
+        if self.dictionary_task:
+            self.dictionary_task.cancel()
+        if self.history_task:
+            self.history_task.cancel()
+        self.deferred.cancel()
+        self.edit_debouncer.cancel()
+        self.delete_debouncer.cancel()
         try:
             # Дожидаемся завершения текущих операций
             await asyncio.sleep(1)
             # Сохраняем состояние
             self._save_state()
+            self.state_store.close()
+            self.message_hashes.close()
+            self.entities.close()
+            self.media_cache.close()
+            self.outbox.close()
+            self.message_map.close()
+            await self.transcoder.close()
             # Отключаем клиента
             await self.client.disconnect()
             logger.info("Клиент остановлен")
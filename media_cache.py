@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+
+from telethon.tl.types import InputDocument, InputPhoto, MessageMediaDocument, MessageMediaPhoto
+
+logger = logging.getLogger(__name__)
+
+
+class MediaCache:
+    """Кеш уже загруженных в Telegram файлов.
+
+    Ключ - id исходного фото/документа (с суффиксом параметров обработки,
+    например сжатия) или sha256 содержимого; значение - ссылка на документ
+    из отправленного сообщения. Следующие цели и повторы отправляют эту
+    ссылку вместо новой загрузки тех же байт. Записи удаляются старше
+    max_age_days и сверх max_bytes суммарного размера (давно не использованные первыми).
+    """
+
+    def __init__(self, path, max_age_days=7, max_bytes=2 * 1024 ** 3, evict_every=100):
+        self.max_age = max_age_days * 86400 if max_age_days > 0 else None
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self._puts = 0
+        self._locks = {}  # key -> [Lock, число ожидающих]
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS media_uploads (
+            key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            media_id INTEGER NOT NULL,
+            access_hash INTEGER NOT NULL,
+            file_reference BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            used REAL NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS ix_media_uploads_used ON media_uploads(used)')
+        self.db.commit()
+        self.evict()
+
+    @staticmethod
+    def source_key(media):
+        """Ключ по id исходного медиа; None для медиа без файла"""
+        if isinstance(media, MessageMediaPhoto) and media.photo:
+            return f"photo:{media.photo.id}"
+        if isinstance(media, MessageMediaDocument) and media.document:
+            return f"document:{media.document.id}"
+        return None
+
+    @staticmethod
+    def content_key(data):
+        return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+    @asynccontextmanager
+    async def lock(self, key):
+        """Одна загрузка на ключ: параллельные цели ждут первую и берут её ссылку"""
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def get(self, key):
+        row = self.db.execute('SELECT kind, media_id, access_hash, file_reference FROM media_uploads WHERE key = ?',
+                              (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute('UPDATE media_uploads SET used = ? WHERE key = ?', (time.time(), key))
+        self.db.commit()
+        kind, media_id, access_hash, file_reference = row
+        input_cls = InputPhoto if kind == 'photo' else InputDocument
+        return input_cls(media_id, access_hash, file_reference)
+
+    def put(self, keys, media, size=0):
+        """Запомнить файл из отправленного сообщения под всеми ключами"""
+        if isinstance(media, MessageMediaPhoto) and media.photo:
+            kind, obj = 'photo', media.photo
+        elif isinstance(media, MessageMediaDocument) and media.document:
+            kind, obj = 'document', media.document
+            size = size or obj.size
+        else:
+            return
+        now = time.time()
+        self.db.executemany(
+            'INSERT OR REPLACE INTO media_uploads (key, kind, media_id, access_hash, file_reference, size, created, used) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(key, kind, obj.id, obj.access_hash, obj.file_reference, size, now, now) for key in keys if key])
+        self.db.commit()
+        self._puts += 1
+        if self._puts % self.evict_every == 0:
+            self.evict()
+
+    def invalidate(self, key):
+        """Ссылка больше не принимается Telegram (истёк file_reference) - файл загрузится заново"""
+        self.db.execute('DELETE FROM media_uploads WHERE key = ?', (key,))
+        self.db.commit()
+
+    def evict(self):
+        removed = 0
+        if self.max_age:
+            removed += self.db.execute('DELETE FROM media_uploads WHERE created < ?',
+                                       (time.time() - self.max_age,)).rowcount
+        if self.max_bytes > 0:
+            # Файл под несколькими ключами (id исходника, sha256) учитывается один раз
+            files = self.db.execute('SELECT media_id, MAX(size), MAX(used) FROM media_uploads '
+                                    'GROUP BY media_id ORDER BY MAX(used)').fetchall()
+            total = sum(size for _, size, _ in files)
+            evicted = []
+            for media_id, size, _ in files:
+                if total <= self.max_bytes:
+                    break
+                evicted.append((media_id,))
+                total -= size
+            removed += sum(self.db.execute('DELETE FROM media_uploads WHERE media_id = ?', row).rowcount
+                           for row in evicted)
+        self.db.commit()
+        if removed:
+            logger.info(f"Из кеша загрузок удалено {removed} записей")
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
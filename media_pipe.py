@@ -0,0 +1,114 @@
+import asyncio
+import logging
+
+from telethon import helpers
+from telethon.tl.functions.upload import SaveBigFilePartRequest
+from telethon.tl.types import InputFileBig
+
+logger = logging.getLogger(__name__)
+
+PART_SIZE = 512 * 1024  # Размер части загрузки (кратен 1 КБ, делит 512 КБ)
+SMALL_FILE_LIMIT = 10 * 1024 * 1024  # До этого размера файл загружается обычным upload_file
+
+# Фрагментированный mp4 пишется в поток без перемотки к началу файла
+STREAMING_MP4_ARGS = ['-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4']
+
+
+async def _parts(chunks):
+    """Нарезка потока произвольных кусков на части по PART_SIZE (последняя - остаток)"""
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= PART_SIZE:
+            yield bytes(buffer[:PART_SIZE])
+            del buffer[:PART_SIZE]
+    if buffer:
+        yield bytes(buffer)
+
+
+async def _read_chunks(reader):
+    while True:
+        chunk = await reader.read(PART_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def upload_stream(client, chunks, name):
+    """Загрузка потока заранее неизвестного размера по мере поступления данных.
+
+    Части уходят в SaveBigFilePart с file_total_parts=-1, настоящее число
+    частей передаётся с последней. В памяти держится не больше
+    SMALL_FILE_LIMIT: пока поток не превысил его, неизвестно, большой ли
+    это файл, и маленький загружается целиком через upload_file.
+    """
+    parts = _parts(chunks)
+    head = []
+    async for part in parts:
+        head.append(part)
+        if len(head) * PART_SIZE > SMALL_FILE_LIMIT:
+            break
+    else:
+        return await client.upload_file(b''.join(head), file_name=name)
+
+    async def all_parts():
+        while head:
+            yield head.pop(0)
+        async for rest in parts:
+            yield rest
+
+    file_id = helpers.generate_random_long()
+    index, current = -1, None
+    async for part in all_parts():
+        if current is not None:
+            await client(SaveBigFilePartRequest(file_id, index, -1, current))
+        index, current = index + 1, part
+    await client(SaveBigFilePartRequest(file_id, index, index + 1, current))
+    return InputFileBig(file_id, index + 1, name)
+
+
+async def transcode_upload(client, media, ffmpeg_args, name='video.mp4'):
+    """Скачивание -> ffmpeg -> загрузка одним конвейером без временных файлов.
+
+    Куски iter_download пишутся в stdin ffmpeg, его stdout загружается частями
+    по мере кодирования - три этапа идут одновременно, а память ограничена
+    буферами канала и одной частью загрузки. Исходник с индексом (moov) в
+    конце файла ffmpeg из канала прочитать не сможет - тогда будет ошибка.
+    """
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-loglevel', 'error', '-i', 'pipe:0', *ffmpeg_args, *STREAMING_MP4_ARGS, 'pipe:1',
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+    async def feed():
+        try:
+            async for chunk in client.iter_download(media):
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg завершился раньше - причину покажет код возврата
+        finally:
+            process.stdin.close()
+
+    async def output():
+        async for chunk in _read_chunks(process.stdout):
+            yield chunk
+        await feeder
+        # Ошибка всплывает до отправки последней части - битый файл не будет собран
+        if await process.wait() != 0:
+            message = (await errors_output).decode(errors='replace').strip()[-500:]
+            raise RuntimeError(f"ffmpeg завершился с кодом {process.returncode}: {message}")
+
+    feeder = asyncio.create_task(feed())
+    errors_output = asyncio.create_task(process.stderr.read())
+    try:
+        return await upload_stream(client, output(), name)
+    except BaseException:
+        feeder.cancel()
+        errors_output.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class MessageMap:
+    """Постоянное соответствие (источник, id) -> (цель, id) для каждой пары каналов.
+
+    Пара (peer источника, peer цели) один раз получает короткий номер
+    маршрута, и строка соответствия - это три целых без rowid: (маршрут,
+    id в источнике, id в цели). id в канале растут, поэтому новые строки
+    дописываются в конец своего маршрута, а последние N записей пары - один
+    отрезок первичного ключа. Обратный индекс (маршрут, id в цели) находит
+    исходное сообщение по сообщению цели. Десятки миллионов строк - это
+    B-дерево глубиной 3-4 страницы, то есть поиск за несколько чтений
+    независимо от размера, а недавние и часто нужные (ответы, правки)
+    отдаёт LRU-кеш в памяти. Записи копятся и фиксируются группой раз в
+    commit_interval сек или по commit_batch штук.
+    """
+
+    def __init__(self, path, cache_size=10000, commit_interval=0.5, commit_batch=100):
+        self.cache_size = cache_size
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self._cache = OrderedDict()  # (маршрут, id в источнике) -> id в цели или None (не копировалось)
+        self._pending = {}  # (маршрут, id в источнике) -> id в цели, ждут группового commit
+        self._flush_handle = None
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS message_routes (
+            id INTEGER PRIMARY KEY,
+            source_peer INTEGER NOT NULL,
+            target_peer INTEGER NOT NULL,
+            UNIQUE (source_peer, target_peer))''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS message_map (
+            route INTEGER NOT NULL,
+            source_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            PRIMARY KEY (route, source_id)) WITHOUT ROWID''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS ix_message_map_target ON message_map(route, target_id)')
+        self.db.commit()
+        self.routes = {(source_peer, target_peer): route for route, source_peer, target_peer
+                       in self.db.execute('SELECT id, source_peer, target_peer FROM message_routes')}
+
+    def _route(self, source_peer, target_peer, create=False):
+        route = self.routes.get((source_peer, target_peer))
+        if route is None and create:
+            route = self.db.execute('INSERT INTO message_routes (source_peer, target_peer) VALUES (?, ?)',
+                                    (source_peer, target_peer)).lastrowid
+            self.db.commit()
+            self.routes[(source_peer, target_peer)] = route
+        return route
+
+    def add(self, source_peer, target_peer, links):
+        """Запомнить пары (id в источнике, id в цели) маршрута"""
+        route = self._route(source_peer, target_peer, create=True)
+        for source_id, target_id in links:
+            self._pending[(route, source_id)] = target_id
+            self._remember((route, source_id), target_id)
+        if len(self._pending) >= self.commit_batch:
+            self.flush()
+        elif self._pending and self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.commit_interval, self.flush)
+
+    def target_id(self, source_peer, target_peer, source_id):
+        """id копии сообщения в цели или None"""
+        route = self._route(source_peer, target_peer)
+        if route is None:
+            return None
+        key = (route, source_id)
+        if key in self._pending:
+            return self._pending[key]
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        row = self.db.execute('SELECT target_id FROM message_map WHERE route = ? AND source_id = ?',
+                              key).fetchone()
+        self._remember(key, row[0] if row else None)
+        return row[0] if row else None
+
+    def _remember(self, key, target_id):
+        self._cache[key] = target_id
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def source_id(self, source_peer, target_peer, target_id):
+        """id исходного сообщения по его копии в цели или None"""
+        route = self._route(source_peer, target_peer)
+        if route is None:
+            return None
+        self.flush()
+        row = self.db.execute('SELECT source_id FROM message_map WHERE route = ? AND target_id = ?',
+                              (route, target_id)).fetchone()
+        return row[0] if row else None
+
+    def last(self, source_peer, target_peer, limit):
+        """Последние limit соответствий маршрута: [(id в источнике, id в цели)] от новых к старым"""
+        route = self._route(source_peer, target_peer)
+        if route is None:
+            return []
+        self.flush()
+        return self.db.execute('SELECT source_id, target_id FROM message_map WHERE route = ? '
+                               'ORDER BY source_id DESC LIMIT ?', (route, limit)).fetchall()
+
+    def remove(self, source_peer, target_peer, source_ids):
+        """Забыть соответствия (копии удалены)"""
+        route = self._route(source_peer, target_peer)
+        if route is None:
+            return
+        self.flush()
+        for source_id in source_ids:
+            self._cache.pop((route, source_id), None)
+        self.db.executemany('DELETE FROM message_map WHERE route = ? AND source_id = ?',
+                            [(route, source_id) for source_id in source_ids])
+        self.db.commit()
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        self.db.executemany('INSERT OR REPLACE INTO message_map (route, source_id, target_id) VALUES (?, ?, ?)',
+                            [(route, source_id, target_id) for (route, source_id), target_id in self._pending.items()])
+        self.db.commit()
+        self._pending.clear()
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import sqlite3
+import time
+
+from albums import Album
+
+logger = logging.getLogger(__name__)
+
+FAILED = -1  # target_id записи, закрытой без доставки после max_attempts неудачных попыток
+
+
+class Outbox:
+    """Исходящие сообщения пар: запись на каждое сообщение, прошедшее фильтр.
+
+    Запись создаётся до отправки (target_id пуст) и закрывается id сообщения
+    в цели (0 - отправлять было нечего: системное, пустое, удалённое в
+    источнике). Незакрытые записи после перезапуска досылаются, а закрытые
+    не отправляются повторно. Неудачные попытки считаются, и после
+    max_attempts запись закрывается как недоставленная (FAILED), чтобы
+    сообщение, которое не отправится никогда, не повторялось бесконечно. Новые записи фиксируются сразу, одним commit на
+    выборку - курсор пары сдвигается только после этого; закрытия копятся и
+    фиксируются группой раз в commit_interval сек или по commit_batch штук.
+    """
+
+    def __init__(self, path, retention_days=30, max_attempts=5, commit_interval=0.5, commit_batch=100):
+        self.retention = retention_days * 86400 if retention_days > 0 else None
+        self.max_attempts = max_attempts
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.inflight = set()  # (pair, source_id), которые сейчас отправляются или ждут в очереди цели
+        self._completed = {}  # (pair, source_id) -> target_id, ждут группового commit
+        self._flush_handle = None
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # В WAL commit без fsync переживает падение процесса - как журнал состояния при state_fsync = interval
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS outbox (
+            pair TEXT NOT NULL,
+            source_id INTEGER NOT NULL,
+            first_id INTEGER NOT NULL,
+            target_id INTEGER,
+            created REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (pair, source_id)) WITHOUT ROWID''')
+        if 'attempts' not in {row[1] for row in self.db.execute('PRAGMA table_info(outbox)')}:
+            self.db.execute('ALTER TABLE outbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+        self.db.execute('CREATE INDEX IF NOT EXISTS ix_outbox_pending ON outbox(created) WHERE target_id IS NULL')
+        self.db.commit()
+        self.prune()
+
+    def add(self, pair, messages):
+        """Незавершённые записи для сообщений (и альбомов - по id последней части) пары"""
+        now = time.time()
+        self.db.executemany(
+            'INSERT OR IGNORE INTO outbox (pair, source_id, first_id, created) VALUES (?, ?, ?, ?)',
+            [(pair, message.id, message.ids[0] if isinstance(message, Album) else message.id, now)
+             for message in messages])
+        self.inflight.update((pair, message.id) for message in messages)
+        self.flush()  # Накопленные закрытия уходят тем же commit
+
+    def delivered(self, pair, source_id) -> bool:
+        if (pair, source_id) in self._completed:
+            return True
+        row = self.db.execute('SELECT target_id FROM outbox WHERE pair = ? AND source_id = ?',
+                              (pair, source_id)).fetchone()
+        return row is not None and row[0] is not None
+
+    def complete(self, pair, source_id, target_id=0):
+        self._completed.setdefault((pair, source_id), target_id)
+        self.inflight.discard((pair, source_id))
+        if len(self._completed) >= self.commit_batch:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.commit_interval, self.flush)
+
+    def release(self, pair, source_ids):
+        """Отправка не удалась - запись остаётся незавершённой и подхватится досылкой.
+
+        После max_attempts неудачных попыток запись закрывается как FAILED; возвращает id таких записей.
+        """
+        self.inflight.difference_update((pair, source_id) for source_id in source_ids)
+        keys = [(pair, source_id) for source_id in source_ids]
+        self.db.executemany('UPDATE outbox SET attempts = attempts + 1 '
+                            'WHERE pair = ? AND source_id = ? AND target_id IS NULL', keys)
+        failed = []
+        if self.max_attempts > 0:
+            for key in keys:
+                row = self.db.execute('SELECT attempts FROM outbox WHERE pair = ? AND source_id = ? '
+                                      'AND target_id IS NULL', key).fetchone()
+                if row is not None and row[0] >= self.max_attempts:
+                    failed.append(key)
+            self.db.executemany(f'UPDATE outbox SET target_id = {FAILED} WHERE pair = ? AND source_id = ?', failed)
+        self.db.commit()
+        for _, source_id in failed:
+            logger.error(f"Пара {pair}: сообщение {source_id} не доставлено за {self.max_attempts} попыток, "
+                         f"запись outbox закрыта без доставки")
+        return [source_id for _, source_id in failed]
+
+    def pending(self, older_than=0):
+        """Незавершённые записи не моложе older_than сек, кроме отправляемых сейчас: pair -> [(source_id, first_id)]"""
+        self.flush()
+        rows = self.db.execute(
+            'SELECT pair, source_id, first_id FROM outbox WHERE target_id IS NULL AND created <= ? '
+            'ORDER BY pair, source_id', (time.time() - older_than,))
+        entries = {}
+        for pair, source_id, first_id in rows:
+            if (pair, source_id) not in self.inflight:
+                entries.setdefault(pair, []).append((source_id, first_id))
+        return entries
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._completed:
+            now = time.time()
+            # Запись без add (отложенный режим) создаётся сразу закрытой; закрытую не перезаписываем
+            self.db.executemany(
+                'INSERT INTO outbox (pair, source_id, first_id, target_id, created) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (pair, source_id) DO UPDATE SET target_id = excluded.target_id '
+                'WHERE target_id IS NULL',
+                [(pair, source_id, source_id, target_id, now)
+                 for (pair, source_id), target_id in self._completed.items()])
+            self._completed.clear()
+        self.db.commit()
+
+    def prune(self):
+        if not self.retention:
+            return
+        removed = self.db.execute('DELETE FROM outbox WHERE target_id IS NOT NULL AND created < ?',
+                                  (time.time() - self.retention,)).rowcount
+        self.db.commit()
+        if removed:
+            logger.info(f"Из outbox удалено {removed} завершённых записей")
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
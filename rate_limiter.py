@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity=None):
+        self.max_rate = rate  # Настроенный предел
+        self.rate = rate  # Текущий (выученный) предел
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now) -> float:
+        """Сколько ждать до следующего токена"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """Глобальное ведро + ведро на каждый целевой чат.
+
+    После FloodWait предел цели снижается вдвое и цель блокируется на время
+    штрафа, затем предел плавно растёт обратно к настроенному (AIMD), так что
+    отправка держится чуть ниже реального лимита Telegram.
+    """
+
+    def __init__(self, global_rate=60, target_rate=20, min_rate=1, increase_every=20):
+        # Пределы задаются в сообщениях в минуту
+        self.global_bucket = TokenBucket(global_rate / 60)
+        self.default_target_rate = target_rate
+        self.min_rate = min_rate / 60
+        self.increase_every = increase_every
+        self.buckets = {}
+        self.penalties = {}  # (peer, метод) -> время окончания штрафа для методов, кроме отправки
+        self.stats = {}
+
+    def configure(self, target, rate):
+        """Индивидуальный предел цели (сообщений в минуту); из нескольких пар берётся меньший"""
+        bucket = self.buckets.get(target)
+        if bucket is None or rate / 60 < bucket.max_rate:
+            self.buckets[target] = TokenBucket(rate / 60)
+
+    def _bucket(self, target):
+        if target not in self.buckets:
+            self.configure(target, self.default_target_rate)
+        return self.buckets[target]
+
+    def _stats(self, target):
+        return self.stats.setdefault(target, {'sent': 0, 'since': time.monotonic(), 'flood_waits': 0,
+                                              'successes': 0})
+
+    async def acquire(self, target):
+        """Дождаться разрешения на одну отправку в target"""
+        bucket = self._bucket(target)
+        while True:
+            now = time.monotonic()
+            wait = max(bucket.delay(now), self.global_bucket.delay(now))
+            if wait <= 0:
+                bucket.consume()
+                self.global_bucket.consume()
+                self._stats(target)['sent'] += 1
+                return
+            await asyncio.sleep(wait)
+
+    def on_success(self, target):
+        """Аддитивный рост предела после серии успешных отправок"""
+        bucket = self._bucket(target)
+        stats = self._stats(target)
+        stats['successes'] += 1
+        if stats['successes'] % self.increase_every == 0 and bucket.rate < bucket.max_rate:
+            bucket.rate = min(bucket.max_rate, bucket.rate + bucket.max_rate * 0.1)
+
+    def on_flood_wait(self, target, seconds):
+        """Мультипликативное снижение предела и блокировка цели на время штрафа"""
+        bucket = self._bucket(target)
+        bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + seconds)
+        bucket.rate = max(self.min_rate, bucket.rate / 2)
+        bucket.tokens = min(bucket.tokens, 0)
+        stats = self._stats(target)
+        stats['flood_waits'] += 1
+        stats['successes'] = 0
+        logger.warning(f"FloodWait {seconds} сек для {target}: предел снижен до {bucket.rate * 60:.1f} сообщ./мин")
+
+    def block(self, peer, method, seconds):
+        """Штраф FloodWait для отдельного метода (например, чтения истории источника)"""
+        until = time.monotonic() + seconds
+        self.penalties[(peer, method)] = max(self.penalties.get((peer, method), 0), until)
+        logger.warning(f"FloodWait {seconds} сек для {method} в {peer}")
+
+    def penalty_left(self, peer, method='send') -> float:
+        """Сколько секунд осталось до конца штрафа"""
+        now = time.monotonic()
+        if method == 'send':
+            return max(0.0, self._bucket(peer).blocked_until - now)
+        return max(0.0, self.penalties.get((peer, method), 0) - now)
+
+    def is_blocked(self, peer, method='send') -> bool:
+        return self.penalty_left(peer, method) > 0
+
+    def report(self):
+        """Пропускная способность по целям с прошлого отчёта: (цель, сообщ./мин, текущий предел, число FloodWait)"""
+        now = time.monotonic()
+        rows = []
+        for target, stats in self.stats.items():
+            minutes = max((now - stats['since']) / 60, 1 / 60)
+            rows.append((target, stats['sent'] / minutes, self._bucket(target).rate * 60, stats['flood_waits']))
+            stats['sent'] = 0
+            stats['since'] = now
+        return rows
+
+
+class DeferredQueue:
+    """Работа для целей под штрафом FloodWait.
+
+    Задачи цели выполняются по порядку отдельной задачей asyncio, как только
+    штраф истекает; остальные цели в это время работают без ожидания.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.queues = {}  # target -> OrderedDict(key -> job)
+        self.tasks = {}
+
+    def __contains__(self, target):
+        return bool(self.queues.get(target))
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def park(self, target, key, job):
+        """Отложить job (корутинная функция без аргументов); повторная постановка того же key игнорируется"""
+        queue = self.queues.setdefault(target, OrderedDict())
+        if key in queue:
+            return
+        queue[key] = job
+        if target not in self.tasks:
+            self.tasks[target] = asyncio.create_task(self._resume(target))
+
+    async def _resume(self, target):
+        queue = self.queues[target]
+        try:
+            while queue:
+                delay = self.limiter.penalty_left(target)
+                if delay > 0:
+                    logger.info(f"{target}: отложено {len(queue)} сообщений, возобновление через {delay:.0f} сек")
+                    await asyncio.sleep(delay)
+                    continue
+
+                key, job = next(iter(queue.items()))
+                try:
+                    await job()
+                except Exception as e:
+                    logger.error(f"Ошибка отложенной задачи для {target}: {e}")
+                if self.limiter.is_blocked(target):
+                    continue  # Новый штраф - задача остаётся первой в очереди
+                queue.pop(key, None)
+        finally:
+            self.tasks.pop(target, None)
+            if not queue:
+                self.queues.pop(target, None)
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
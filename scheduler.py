@@ -0,0 +1,155 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class ScheduledPost:
+    """Компактная запись отложенного поста: без живых объектов Telethon, сериализуется в плоский список"""
+
+    __slots__ = ('source', 'source_peer', 'message_id', 'target', 'pair', 'due', 'caption', 'media', 'group',
+                 'message_hash')
+
+    def __init__(self, source, source_peer, message_id, target, pair, due, caption=None, media=None, group=None,
+                 message_hash=None):
+        self.source = source  # Источник как в конфиге
+        self.source_peer = source_peer  # peer id источника (int) или None
+        self.message_id = message_id
+        self.target = target
+        self.pair = pair  # Имя пары
+        self.due = due  # Время публикации, unix time
+        self.caption = caption  # Готовая подпись (html) на случай, если оригинал недоступен
+        self.media = media  # [тип, id, access_hash, file_reference в base64] или None
+        self.group = group  # id всех частей альбома (message_id - последняя) или None
+        self.message_hash = message_hash  # Хеш дедупликации оригинала - отмечается и при публикации по записи
+
+    @property
+    def key(self):
+        return f"{self.pair}:{self.message_id}"
+
+    def to_list(self):
+        return [self.source, self.source_peer, self.message_id, self.target,
+                self.pair, self.due, self.caption, self.media, self.group, self.message_hash]
+
+    @classmethod
+    def from_list(cls, data):
+        return cls(*data)
+
+
+class PostScheduler:
+    """Таймерный планировщик отложенных постов.
+
+    Посты каждой цели лежат в своей куче по (время, порядковый номер), а цели -
+    в общей куче по сроку своего первого поста. get() спит ровно до ближайшего
+    срока и просыпается сразу, если вставлен более ранний пост. Пока выданный
+    пост цели не подтверждён через done() или возвращён через retry(), следующие
+    посты этой цели не выдаются - порядок внутри цели сохраняется, остальные
+    цели не блокируются.
+    """
+
+    def __init__(self):
+        self._posts = {}  # target -> куча [(due, seq, post)]
+        self._not_before = {}  # target -> время, раньше которого цель не трогаем (повтор)
+        self._ready = []  # куча [(key, seq, target)] с ленивым удалением устаревших записей
+        self._keys = {}  # target -> актуальный ключ в _ready
+        self._inflight = {}  # id(post) -> (due, seq, post) выданных, но ещё не подтверждённых постов
+        self._busy = set()  # Цели с постом в работе - их следующие посты не выдаются
+        self._seq = itertools.count()
+        self._changed = asyncio.Event()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def push(self, post, target, due: float):
+        """Добавить пост для цели target со сроком due (unix time)"""
+        self._push_entry(target, (due, next(self._seq), post))
+
+    def retry(self, post, target, delay: float):
+        """Вернуть выданный пост на прежнее место в очереди цели и придержать цель на delay секунд"""
+        entry = self._inflight.pop(id(post), None)
+        if entry is None:
+            return  # Пост уже подтверждён через done()
+        due, seq, _ = entry
+        self._busy.discard(target)
+        self._not_before[target] = time.time() + delay
+        self._push_entry(target, (due, seq, post))
+
+    def done(self, post, target):
+        """Подтвердить публикацию (или отказ от) выданного поста"""
+        self._inflight.pop(id(post), None)
+        self._busy.discard(target)
+        if target in self._posts:
+            self._reschedule(target)
+
+    def posts(self):
+        """Все ожидающие посты, включая выданные, в порядке сроков (для сохранения состояния)"""
+        entries = [entry for heap in self._posts.values() for entry in heap]
+        entries.extend(self._inflight.values())
+        return [post for _, _, post in sorted(entries, key=lambda e: (e[0], e[1]))]
+
+    def due(self, now=None):
+        """Наступившие посты всех целей без извлечения (для пакетной подгрузки сообщений)"""
+        now = time.time() if now is None else now
+        result = []
+        for heap in self._posts.values():
+            # Обход кучи с отсечением: потомки позднего узла тоже поздние
+            stack = [0]
+            while stack:
+                i = stack.pop()
+                if i >= len(heap) or heap[i][0] > now:
+                    continue
+                result.append(heap[i][2])
+                stack.extend((2 * i + 1, 2 * i + 2))
+        return result
+
+    async def get(self):
+        """Дождаться и выдать ближайший наступивший пост"""
+        while True:
+            self._drop_stale()
+            if not self._ready:
+                self._changed.clear()
+                await self._changed.wait()
+                continue
+
+            key, _, target = self._ready[0]
+            delay = key - time.time()
+            if delay > 0:
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._ready)
+            del self._keys[target]
+            self._not_before.pop(target, None)
+            due, seq, post = heapq.heappop(self._posts[target])
+            self._size -= 1
+            self._inflight[id(post)] = (due, seq, post)
+            self._busy.add(target)
+            if not self._posts[target]:
+                del self._posts[target]
+            return post
+
+    def _push_entry(self, target, entry):
+        heapq.heappush(self._posts.setdefault(target, []), entry)
+        self._size += 1
+        self._reschedule(target)
+
+    def _reschedule(self, target):
+        if target in self._busy:
+            return
+        key = max(self._posts[target][0][0], self._not_before.get(target, 0))
+        if self._keys.get(target) != key:
+            self._keys[target] = key
+            heapq.heappush(self._ready, (key, next(self._seq), target))
+            self._changed.set()
+
+    def _drop_stale(self):
+        while self._ready and self._keys.get(self._ready[0][2]) != self._ready[0][0]:
+            heapq.heappop(self._ready)
@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+class StateJournal:
+    """Хранилище состояния: снимок (checkpoint) + журнал дельт в формате JSON lines.
+
+    Каждое изменение дописывается в журнал одной строкой, снимок
+    перезаписывается атомарно (tmp + os.replace) только при компактификации.
+    """
+
+    def __init__(self, path, fsync='interval', fsync_interval=1.0, compact_every=1000):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Неизвестная политика fsync: {fsync} (допустимо: {', '.join(FSYNC_POLICIES)})")
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self._journal = None
+        self._seq = 0
+        self._records = 0  # Записей в журнале с момента последнего снимка
+        self._last_fsync = 0.0
+
+    def load(self, default=None) -> dict:
+        """Чтение снимка и проигрывание журнала поверх него"""
+        state = self._read_snapshot()
+        if state is None:
+            state = default if default is not None else {}
+        self._seq = state.pop('journal_seq', 0)
+
+        replayed = 0
+        valid_size = 0
+        try:
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('нет конца строки')
+                        record = json.loads(line)
+                    except ValueError:
+                        # Недописанная строка после аварийного завершения - отрезаем хвост,
+                        # чтобы новые записи не склеились с мусором
+                        logger.warning(f"Журнал {self.journal_path}: обрезанная запись, остальное отброшено")
+                        with open(self.journal_path, 'r+b') as tail:
+                            tail.truncate(valid_size)
+                        break
+                    valid_size += len(line)
+                    if record['seq'] <= self._seq:
+                        continue
+                    self._apply(state, record)
+                    self._seq = record['seq']
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+
+        self._records = replayed
+        if replayed:
+            logger.info(f"Восстановлено {replayed} изменений состояния из журнала")
+        return state
+
+    def append(self, section, key, value):
+        """Дописать изменение state[section][key] = value в журнал (None - удалить ключ)"""
+        self._seq += 1
+        record = {'seq': self._seq, 's': section, 'k': key, 'v': value}
+        f = self._open_journal()
+        f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+        f.flush()
+        if self.fsync == 'always' or (
+                self.fsync == 'interval' and time.monotonic() - self._last_fsync >= self.fsync_interval):
+            self._sync(f)
+        self._records += 1
+
+    def needs_compaction(self) -> bool:
+        return self._records >= self.compact_every
+
+    def checkpoint(self, state):
+        """Атомарная запись полного снимка и очистка журнала"""
+        snapshot = dict(state, journal_seq=self._seq)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False, indent=2)
+            f.flush()
+            if self.fsync != 'never':
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if self.fsync != 'never':
+            self._sync_dir()
+
+        # Журнал обнуляется только после того, как новый снимок на диске
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_path, 'w', encoding='utf-8')
+        self._records = 0
+
+    def close(self):
+        if self._journal is not None:
+            if self.fsync != 'never':
+                self._sync(self._journal)
+            self._journal.close()
+            self._journal = None
+
+    def _read_snapshot(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError as e:
+            # Снимок пишется атомарно, поэтому битый файл - повод остановиться, а не начать с нуля
+            raise ValueError(f"Файл состояния {self.path} повреждён: {e}")
+
+    def _open_journal(self):
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        return self._journal
+
+    def _sync(self, f):
+        os.fsync(f.fileno())
+        self._last_fsync = time.monotonic()
+
+    def _sync_dir(self):
+        if not hasattr(os, 'O_DIRECTORY'):
+            return  # Windows
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _apply(state, record):
+        section = state.get(record['s'])
+        if not isinstance(section, dict):
+            section = state[record['s']] = {}
+        if record['v'] is None:
+            section.pop(record['k'], None)
+        else:
+            section[record['k']] = record['v']
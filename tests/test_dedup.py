@@ -0,0 +1,13 @@
+from dedup import DedupIndex
+
+
+def test_pruned_hash_not_duplicate(tmp_path):
+    """Хеш, удалённый по количеству, больше не считается дубликатом, хотя был в кеше"""
+    index = DedupIndex(str(tmp_path / 'dedup.db'), retention_days=0, max_entries=2, prune_every=1000)
+    for message_hash in ('a', 'b', 'c'):
+        index.add(message_hash)
+    assert 'a' in index
+    index.prune()
+    assert 'a' not in index
+    assert 'b' in index and 'c' in index
+    index.close()
@@ -0,0 +1,53 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('telethon')
+from telethon import errors  # noqa: E402
+
+from history import HistoryReader, TakeoutHistoryReader  # noqa: E402
+
+
+class FakeClient:
+    """Клиент с историей из id 1..last; fail_after - после стольких сообщений выборка падает с error"""
+
+    def __init__(self, last, fail_after=None, error=None):
+        self.last = last
+        self.fail_after = fail_after
+        self.error = error
+        self.calls = []
+
+    async def iter_messages(self, peer, min_id=0, max_id=0, offset_date=None, reverse=False, wait_time=None):
+        self.calls.append(min_id)
+        for n, message_id in enumerate(range(min_id + 1, self.last + 1)):
+            if n == self.fail_after:
+                raise self.error
+            yield SimpleNamespace(id=message_id)
+
+
+async def _read(reader, peer='source', min_id=0):
+    return [message.id async for message in reader.iter_messages(peer, min_id=min_id)]
+
+
+def test_takeout_falls_back_mid_read():
+    """Отказ takeout-сессии посреди чтения: выборка продолжается обычным чтением с последнего id"""
+    takeout = FakeClient(10, fail_after=4, error=errors.TakeoutInvalidError(request=None))
+    client = FakeClient(10)
+    reader = TakeoutHistoryReader(takeout, HistoryReader(client))
+
+    assert asyncio.run(_read(reader, min_id=2)) == list(range(3, 11))
+    assert client.calls == [6]
+    assert not reader.active
+
+
+def test_source_error_keeps_takeout():
+    """Ошибка самого источника пробрасывается и не выключает takeout для остальных источников"""
+    takeout = FakeClient(10, fail_after=0, error=errors.ChannelPrivateError(request=None))
+    client = FakeClient(10)
+    reader = TakeoutHistoryReader(takeout, HistoryReader(client))
+
+    with pytest.raises(errors.ChannelPrivateError):
+        asyncio.run(_read(reader))
+    assert reader.active
+    assert client.calls == []
@@ -0,0 +1,32 @@
+import sqlite3
+from types import SimpleNamespace
+
+from outbox import Outbox
+
+
+def test_poison_message_closed_after_max_attempts(tmp_path):
+    """Сообщение, которое не отправляется, досылается max_attempts раз и закрывается без доставки"""
+    outbox = Outbox(str(tmp_path / 'outbox.db'), max_attempts=3)
+    outbox.add('pair', [SimpleNamespace(id=7)])
+    for _ in range(2):
+        assert outbox.release('pair', [7]) == []
+        assert outbox.pending() == {'pair': [(7, 7)]}
+        assert not outbox.delivered('pair', 7)
+    assert outbox.release('pair', [7]) == [7]
+    assert outbox.pending() == {}
+    assert outbox.delivered('pair', 7)
+    outbox.close()
+
+
+def test_attempts_added_to_existing_table(tmp_path):
+    """Таблица, созданная до счётчика попыток, получает колонку при открытии"""
+    path = str(tmp_path / 'outbox.db')
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE outbox (pair TEXT NOT NULL, source_id INTEGER NOT NULL, first_id INTEGER NOT NULL, '
+               'target_id INTEGER, created REAL NOT NULL, PRIMARY KEY (pair, source_id)) WITHOUT ROWID')
+    db.execute("INSERT INTO outbox VALUES ('pair', 1, 1, NULL, 0)")
+    db.commit()
+    db.close()
+    outbox = Outbox(path, retention_days=0, max_attempts=1)
+    assert outbox.release('pair', [1]) == [1]
+    outbox.close()
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from transcoder import TranscodePool
+
+
+def test_close_while_busy():
+    """Закрытие пула во время перекодирования снимает задачу и не зависает"""
+    async def scenario():
+        pool = TranscodePool(workers=1)
+        started = asyncio.Event()
+        stopped = asyncio.Event()
+
+        async def run():
+            started.set()
+            try:
+                await asyncio.sleep(100)
+            finally:
+                stopped.set()
+
+        waiter = asyncio.create_task(pool.submit('video', run))
+        await started.wait()
+        await asyncio.wait_for(pool.close(), 3)
+        assert stopped.is_set()
+        assert not pool.jobs
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(waiter, 3)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_job_keeps_worker():
+    """Отмена одной задачи не останавливает рабочего: следующая выполняется"""
+    async def scenario():
+        pool = TranscodePool(workers=1)
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(100)
+
+        async def fast():
+            return 'done'
+
+        waiter = asyncio.create_task(pool.submit('slow', slow))
+        await started.wait()
+        waiter.cancel()
+        assert await asyncio.wait_for(pool.submit('fast', fast), 3) == 'done'
+        await asyncio.wait_for(pool.close(), 3)
+
+    asyncio.run(scenario())
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import itertools
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_LIVE = 0  # Новые сообщения
+PRIORITY_HISTORY = 10  # Копирование истории - после живых
+
+
+def transcode_key(source_key, ffmpeg_args):
+    """Ключ результата: исходный документ + параметры кодирования"""
+    params = hashlib.sha1(' '.join(ffmpeg_args).encode()).hexdigest()[:12]
+    return f"{source_key}:ffmpeg-{params}"
+
+
+class TranscodeJob:
+    __slots__ = ('key', 'run', 'timeout', 'future', 'waiters', 'task')
+
+    def __init__(self, key, run, timeout):
+        self.key = key
+        self.run = run  # Корутинная функция без аргументов
+        self.timeout = timeout
+        self.future = asyncio.get_running_loop().create_future()
+        self.waiters = 0
+        self.task = None
+
+
+class TranscodePool:
+    """Ограниченный пул перекодирования поверх asyncio-подпроцессов.
+
+    Одновременно работает не больше workers задач (по умолчанию - по числу
+    ядер), остальные ждут в очереди по приоритету. Одинаковые задачи (по
+    ключу исходника и параметров) не запускаются дважды: повторный submit
+    ждёт уже идущую. Задача снимается по таймауту или когда её больше
+    никто не ждёт; отмена доходит до ffmpeg, и процесс завершается.
+    """
+
+    def __init__(self, workers=None, timeout=1800):
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.jobs = {}  # key -> TranscodeJob (в очереди или в работе)
+        self._queue = None
+        self._tasks = []
+        self._seq = itertools.count()
+
+    def _start(self):
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, key, run, priority=PRIORITY_LIVE, timeout=None):
+        """Выполнить run() в пуле и вернуть результат; задача с тем же key выполняется один раз"""
+        if self._queue is None:
+            self._start()
+        job = self.jobs.get(key)
+        if job is None:
+            job = self.jobs[key] = TranscodeJob(key, run, timeout or self.timeout)
+            self._queue.put_nowait((priority, next(self._seq), job))
+            if self._queue.qsize() > self.workers:
+                logger.info(f"Перекодирование {key} в очереди: {self._queue.qsize()} задач ждут")
+
+        job.waiters += 1
+        try:
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            if job.waiters == 1:
+                self.cancel(key)
+            raise
+        finally:
+            job.waiters -= 1
+
+    def cancel(self, key):
+        job = self.jobs.pop(key, None)
+        if job is None:
+            return
+        if job.task is not None:
+            job.task.cancel()
+        elif not job.future.done():
+            job.future.cancel()  # Ещё в очереди - рабочий её пропустит
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            if job.future.done():
+                continue
+            job.task = asyncio.create_task(asyncio.wait_for(job.run(), job.timeout))
+            try:
+                # wait не пробрасывает отмену задачи в рабочего и наоборот - их отмены не путаются
+                await asyncio.wait({job.task})
+            except asyncio.CancelledError:
+                # Отменён сам рабочий (закрытие пула): задача снимается вместе с ним, ffmpeg завершается
+                job.task.cancel()
+                await asyncio.wait({job.task})
+                if not job.future.done():
+                    job.future.cancel()
+                if self.jobs.get(job.key) is job:
+                    del self.jobs[job.key]
+                raise
+            try:
+                result = job.task.result()
+            except asyncio.CancelledError:
+                job.future.cancel()
+            except asyncio.TimeoutError:
+                logger.error(f"Перекодирование {job.key} прервано по таймауту {job.timeout} сек")
+                job.future.set_exception(TimeoutError(f"Таймаут перекодирования {job.key}"))
+            except Exception as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                if self.jobs.get(job.key) is job:
+                    del self.jobs[job.key]
+
+    async def close(self):
+        for key in list(self.jobs):
+            self.cancel(key)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None